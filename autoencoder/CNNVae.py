@@ -1,6 +1,8 @@
 # import os
+import copy
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 # import numpy as np
 # from tqdm import tqdm
 # from torchvision import transforms
@@ -9,16 +11,33 @@ import torch.nn as nn
 device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
 
 
+def load_weights(path,device):
+    """
+    state dict of a .safetensors (model store) or .pth file, memory mapped instead of read into memory
+    """
+    if str(path).endswith('.safetensors'):
+        from safetensors.torch import load_file
+        return load_file(path,device=str(device))
+    try:
+        return torch.load(path, map_location=torch.device(device), weights_only=True, mmap=True)
+    except RuntimeError:
+        # files written with the legacy (non zip) format can't be memory mapped
+        return torch.load(path, map_location=torch.device(device), weights_only=True)
+
+
 
 class Encoder(nn.Module):
 
     """
     config : [con(input chanel,kernel size,stride,pad),..] = [layer1,..]
+
+    deterministic: inference mode, forward returns mu without sampling or the kl term
     
     """
 
     def __init__(self, 
                  latent_dims=64,
+                 deterministic=False,
                  ):  
         super().__init__()
 
@@ -53,6 +72,7 @@ class Encoder(nn.Module):
         # self.N.loc = self.N.loc.to(device)
         # self.N.scale = self.N.scale.to(device)
         self.kl = 0
+        self.deterministic = deterministic
 
         self.to(self.device)
 
@@ -65,16 +85,30 @@ class Encoder(nn.Module):
         x = torch.flatten(x, start_dim=1)
         x = self.linear(x)
         mu =  self.mu(x)
+        if self.deterministic:
+            return mu
         sigma = torch.exp(self.sigma(x))
         z = mu + sigma*self.N.sample(mu.shape).to(self.device)
         self.kl = (sigma**2 + mu**2 - torch.log(sigma) - 0.5).sum()
         return z
 
+    def fused(self):
+        """
+        deterministic eval copy with the BatchNorms folded into their convs, conv + LeakyReLU
+        pairs are left to the TorchScript / onnx runtime graph fusion
+        """
+        model = copy.deepcopy(self).eval()
+        model.deterministic = True
+        for name in ('encoder_layer2','encoder_layer4'):
+            conv, bn, act = getattr(model,name)
+            setattr(model,name,nn.Sequential(fuse_conv_bn_eval(conv,bn),act))
+        return model
+
     def save(self,path):
         torch.save(self.state_dict(), path)
 
     def load(self,path):
-        self.load_state_dict(torch.load(path, map_location=torch.device(self.device), weights_only=True))
+        self.load_state_dict(load_weights(path,self.device))
 
 class Decoder(nn.Module):
     
@@ -115,7 +149,7 @@ class Decoder(nn.Module):
         torch.save(self.state_dict(), path)
 
     def load(self,path):
-        self.load_state_dict(torch.load(path, map_location=torch.device(self.device), weights_only=True))
+        self.load_state_dict(load_weights(path,self.device))
 
 
 # class VariationalAutoencoder(nn.Module):
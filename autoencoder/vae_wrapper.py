@@ -1,5 +1,8 @@
+import os
 from autoencoder.CNNVae import Encoder,Decoder
+from wrapper.timing_cache import timed_warmup,timed_benchmark
 import torch
+import torch.nn.functional as F
 import cv2
 import time
 from torchvision import transforms
@@ -15,39 +18,138 @@ class VencoderWrapper:
 
     """
     model_path: pth path
+    warmup_shape: (h,w) seg map shape of the warmup pass, default the encoder input size
+    warmup_batch: seg maps of the warmup pass (number of cameras), 0 skips warmup
+    resize_mode: resize of the batched input path. 'bilinear' (default) is the antialiased
+                 resize the existing agents were trained on (PIL Resize), lists of maps that need
+                 a resize keep going through PIL and match it exactly. stacked arrays / tensors
+                 are resized by torch, close to PIL but not bit-identical: inputs differ by at most
+                 0.25 (one level after /4) on ~1.3% of the pixels of a 640x1280 drive seg map,
+                 more on noisy maps.
+                 'nearest' (opt-in) keeps label values and sends lists through the batched path too
+    deterministic: return mu, no sampling / kl, latents are reproducible
+    jit: run the fused deterministic encoder as a frozen TorchScript graph (needs deterministic)
+
+    seg maps given as a stacked (n_cam,h,w) uint8 array / tensor, or a list of same shape uint8
+    maps (245x245 or resize_mode 'nearest') go through the batched path: resize, cast and /4 scaling written into a preallocated
+    (n_cam,1,245,245) tensor on the encoder device. compare_input_paths() times it against PIL
+    and reports how far its input is from the PIL one.
     """
     
-    def __init__(self,model_path,latent_dims,custom_process=None):
+    def __init__(self,model_path,latent_dims,custom_process=None,warmup_shape=None,warmup_batch=1,
+                 resize_mode='bilinear',deterministic=False,jit=False):
         print('===== Encoder =====')
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"using {self.device}")
         self.latent_dims = latent_dims 
-        self.model = Encoder(latent_dims=self.latent_dims)
+        self.model = Encoder(latent_dims=self.latent_dims,deterministic=deterministic)
         self.model.load(model_path)
         self.model.eval()
+        if jit:
+            assert deterministic, "jit needs the deterministic encoder"
+            self.model = script_encoder(self.model)
 
         default_transforms = transforms.Compose([transforms.Resize((245, 245)),
                                         transforms.ToTensor(),
                         transforms.Lambda(lambda x: ((x * 255.0) / 4.0))
                         ])
         self.processor = custom_process or default_transforms
+        assert resize_mode in ('nearest','bilinear')
+        self.input_size = (245,245)
+        self.fast_input = custom_process is None
+        self.resize_mode = resize_mode
+        self.input_buffer = None
+        self.nearest_index = {}
+
+        self.model_id = os.path.abspath(model_path)
+        self.backend = "-".join([f"encoder-{self.device}"]+(['mu'] if deterministic else [])+(['jit'] if jit else []))
+        if warmup_batch:
+            self.warmup(image_shape=warmup_shape,batch=warmup_batch)
+
+    def warmup(self,image_shape=None,batch=1):
+        """
+        one pass at the deployment shape, prints the latency cached by benchmark()
+        """
+        image_shape = tuple(image_shape or self.input_size)
+        dummy_images = [np.random.randint(0, 4, image_shape, dtype=np.uint8)]*batch
+        timed_warmup(lambda: self(dummy_images),self.model_id,self.backend,(batch,)+image_shape)
+
+    def benchmark(self,image_shape=None,batch=1,test_times=20):
+        """
+        timing loop at the deployment shape, stored in the timing cache
+        return: mean seconds per call
+        """
+        image_shape = tuple(image_shape or self.input_size)
+        dummy_images = [np.random.randint(0, 4, image_shape, dtype=np.uint8)]*batch
+        return timed_benchmark(lambda: self(dummy_images),self.model_id,self.backend,(batch,)+image_shape,test_times)
+
+    def compare_input_paths(self,image_shape=(640,1280),batch=2,test_times=20):
+        """
+        per call latency of the PIL input path and the batched path (preprocess only) and the
+        difference of their encoder inputs
+        return: {'pil': seconds, 'batched': seconds,
+                 'max_diff': max abs input difference, 'diff_fraction': fraction of input pixels that differ}
+        """
+        segs = np.random.randint(0, 5, (batch,)+tuple(image_shape), dtype=np.uint8)
+        pil_input = torch.stack([self.processor(Image.fromarray(seg)) for seg in segs]).to(self.device)
+        diff = (self._batched_input(segs)-pil_input).abs()
+        results = {'max_diff':diff.max().item(),'diff_fraction':(diff > 1e-6).float().mean().item()}
+        for name,process in [('pil',lambda: torch.stack([self.processor(Image.fromarray(seg)) for seg in segs])),
+                             ('batched',lambda: self._batched_input(segs))]:
+            process()
+            st = time.time()
+            for _ in range(test_times):
+                process()
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            results[name] = (time.time()-st)/test_times
+        print(f"encoder input pil :{results['pil']:.6f} batched :{results['batched']:.6f} "
+              f"max diff :{results['max_diff']:.4f} differing :{results['diff_fraction']*100:.2f}%")
+        return results
+
+    def _nearest_rows_cols(self,height,width):
+        """
+        source row / column of every encoder input pixel, pixel centers like F.interpolate nearest-exact
+        """
+        if (height,width) not in self.nearest_index:
+            rows = ((torch.arange(self.input_size[0])+0.5)*height/self.input_size[0]).long().clamp_(max=height-1)
+            cols = ((torch.arange(self.input_size[1])+0.5)*width/self.input_size[1]).long().clamp_(max=width-1)
+            self.nearest_index[(height,width)] = (rows.view(-1,1).to(self.device),cols.to(self.device))
+        return self.nearest_index[(height,width)]
+
+    def _batched_input(self,segs):
+        """
+        input: (batch,h,w) or (h,w) uint8 seg maps, numpy or torch on any device
+        return: encoder input in the preallocated (batch,1,245,245) buffer
+        """
+        x = torch.as_tensor(segs).to(self.device,non_blocking=True)
+        x = x.reshape(-1,*x.shape[-2:])
+        shape = (x.shape[0],1)+self.input_size
+        if self.input_buffer is None or tuple(self.input_buffer.shape) != shape:
+            self.input_buffer = torch.empty(shape,dtype=torch.float32,device=self.device)
+
+        if tuple(x.shape[-2:]) != self.input_size:
+            if self.resize_mode == 'nearest':
+                rows,cols = self._nearest_rows_cols(*x.shape[-2:])
+                x = x[:,rows,cols]
+            else:
+                # PIL bilinear downsampling is antialiased and rounds back to uint8,
+                # torch's kernel differs by one level on a few pixels (see compare_input_paths)
+                x = F.interpolate(x.unsqueeze(1).float(),size=self.input_size,mode='bilinear',
+                                  antialias=True,align_corners=False).round_().squeeze(1)
+        # cast + ToTensor /255 + Lambda *255/4 in one op
+        torch.mul(x.unsqueeze(1),0.25,out=self.input_buffer)
+        return self.input_buffer
 
-        self.warmup()
-
-    def warmup(self,image_shape=(512,1024)):
-        # warmup
-        dummy_images = np.random.randint(0, 4, image_shape, dtype=np.uint8)
-        self(dummy_images)
-        test_times = 20
-        st = time.time()
-        for _ in range(test_times):
-            self(dummy_images)
-        print(f"inference time :{(time.time()-st)/test_times:.6f}")
- 
-        
     def __call__(self,image):
         
-        if isinstance(image,np.ndarray):
+        if isinstance(image,torch.Tensor) or (isinstance(image,np.ndarray) and image.ndim == 3):
+            preprocessed = self._batched_input(image)
+        elif self.fast_input and isinstance(image,list) and \
+                all(img.dtype == np.uint8 and img.shape == image[0].shape for img in image) and \
+                (self.resize_mode == 'nearest' or image[0].shape == self.input_size):
+            preprocessed = self._batched_input(np.stack(image))
+        elif isinstance(image,np.ndarray):
             image = Image.fromarray(image)
             preprocessed = self.processor(image).unsqueeze(0)
         elif isinstance(image,list):
@@ -60,13 +162,47 @@ class VencoderWrapper:
         return latent
 
 
+def script_encoder(encoder,input_size=(245,245)):
+    """
+    fused deterministic encoder traced, frozen and optimized for inference (conv + bn / activation fusion)
+    """
+    model = encoder.fused()
+    example = torch.zeros((1,1)+tuple(input_size),device=model.device)
+    with torch.no_grad():
+        traced = torch.jit.trace(model,example)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+def export_encoder(model_path,latent_dims,export_path,input_size=(245,245),opset=17):
+    """
+    export the fused deterministic encoder (mu only), .onnx or TorchScript (.pt)
+    onnx runtime fuses the Conv + LeakyRelu pairs when the session is created
+    return: export_path
+    """
+    encoder = Encoder(latent_dims=latent_dims)
+    encoder.load(model_path)
+    if export_path.endswith('.onnx'):
+        model = encoder.fused()
+        example = torch.zeros((1,1)+tuple(input_size),device=model.device)
+        with torch.no_grad():
+            torch.onnx.export(model,(example,),export_path,
+                              input_names=['segs'],output_names=['mu'],
+                              dynamic_axes={'segs':{0:'batch'},'mu':{0:'batch'}},
+                              opset_version=opset,dynamo=False)
+    else:
+        torch.jit.save(script_encoder(encoder.eval(),input_size),export_path)
+    print(f"exported encoder to {export_path}")
+    return export_path
+
+
 class DecoderWrapper():
 
     """
     model_path: pth path
+    warmup_batch: latents of the warmup pass (number of cameras), 0 skips warmup
     """
     
-    def __init__(self,model_path,latent_dims):
+    def __init__(self,model_path,latent_dims,warmup_batch=1):
         print('===== Decoder =====')
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"using {self.device}")
@@ -75,17 +211,26 @@ class DecoderWrapper():
         self.model.load(model_path)
         self.model.eval()
 
-        self.warmup()
-
-    def warmup(self,latent_size = (1,32)):
-        # warmup
-        dummy = torch.rand(latent_size).to(self.device)
-        self(dummy)
-        test_times = 20
-        st = time.time()
-        for _ in range(test_times):
-            self(dummy)
-        print(f"inference time :{(time.time()-st)/test_times:.6f}")
+        self.latent_dims = latent_dims
+        self.model_id = os.path.abspath(model_path)
+        self.backend = f"decoder-{self.device}"
+        if warmup_batch:
+            self.warmup(batch=warmup_batch)
+
+    def warmup(self,batch=1):
+        """
+        one pass with batch latents, prints the latency cached by benchmark()
+        """
+        dummy = torch.rand((batch,self.latent_dims)).to(self.device)
+        timed_warmup(lambda: self(dummy),self.model_id,self.backend,(batch,self.latent_dims))
+
+    def benchmark(self,batch=1,test_times=20):
+        """
+        timing loop, stored in the timing cache
+        return: mean seconds per call
+        """
+        dummy = torch.rand((batch,self.latent_dims)).to(self.device)
+        return timed_benchmark(lambda: self(dummy),self.model_id,self.backend,(batch,self.latent_dims),test_times)
  
         
     def __call__(self,latents,post_process=True):
@@ -104,4 +249,3 @@ class DecoderWrapper():
 
 
         
-
@@ -0,0 +1,122 @@
+"""
+headless throughput benchmark of AVbot.step and Agent.__call__ on recorded frames
+
+python benchmark.py RLmodel/SAC_51/model.zip --source drive.avi --steps 200
+sources can be video files, image directories or drive logs ("log_dir#1" for camera 1)
+
+python benchmark.py RLmodel/SAC_51/model.zip --perception
+compares staged seg + vae wrappers with the eager and compiled PerceptionModule, no cameras needed
+
+python benchmark.py RLmodel/SAC_51/model.zip --models
+timing loop of the seg, vae encoder and decoder wrappers at the deployment shape, the results are
+stored in the timing cache and printed by the warmup of later agent loads
+"""
+import argparse
+import time
+import numpy as np
+
+from system.Robot import AVbot
+from system.modules.sources import open_source
+
+
+def summarize(name,times):
+    times = np.array(times)*1000
+    print(f"{name:<14} mean {times.mean():8.2f} ms  p50 {np.percentile(times,50):8.2f} ms  "
+          f"p95 {np.percentile(times,95):8.2f} ms  {1000/times.mean():7.2f} steps/s")
+
+
+def benchmark_perception_module(model_path,steps):
+    from system.modules.agent import Agent
+    from wrapper.perception import benchmark_perception
+
+    agent = Agent(model_path)
+    try:
+        observer = agent.observer
+        image_shape = agent.crop or agent.resolution[::-1]
+        benchmark_perception(observer.seg,observer.vae_encoder,agent.n_cam,image_shape,test_times=steps)
+    finally:
+        agent.close()
+
+
+def benchmark_models(model_path,steps):
+    from system.modules.agent import Agent
+
+    agent = Agent(model_path)
+    try:
+        observer = agent.observer
+        print("===== Segmentation =====")
+        observer.seg.benchmark(batch=agent.n_cam,test_times=steps)
+        print("===== Encoder =====")
+        observer.vae_encoder.benchmark(image_shape=getattr(observer.seg,'output_shape',None),
+                                       batch=agent.n_cam,test_times=steps)
+        if observer.vae_decoder is not None:
+            print("===== Decoder =====")
+            observer.vae_decoder.benchmark(batch=agent.n_cam,test_times=steps)
+    finally:
+        agent.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the agent pipeline without cameras")
+    parser.add_argument("model_path",help="agent zip, config.json must be next to it")
+    parser.add_argument("--source",nargs='+',help="one source per camera, the last one is reused (opened again for every remaining camera)")
+    parser.add_argument("--steps",type=int,default=100)
+    parser.add_argument("--warmup",type=int,default=5)
+    parser.add_argument("--realtime",action="store_true",help="pace sources to their fps instead of free-running")
+    parser.add_argument("--perception",action="store_true",help="eager vs compiled perception module latency")
+    parser.add_argument("--models",action="store_true",help="time the model wrappers and fill the timing cache")
+    args = parser.parse_args()
+    if not (args.perception or args.models) and not args.source:
+        parser.error("--source is required unless --perception or --models is set")
+
+    if args.perception:
+        benchmark_perception_module(args.model_path,args.steps)
+        return
+    if args.models:
+        benchmark_models(args.model_path,args.steps)
+        return
+
+    robot = AVbot(cam_config={'realtime_sources':args.realtime})
+    try:
+        robot.init_agent(args.model_path)
+        # no display, the render thread would compete with the timed steps
+        robot.renderer.close()
+        robot.renderer = None
+        # no sleeping to delta_frame, run as fast as the pipeline allows
+        robot.delta_frame = 0
+        for pos in range(robot.agent.n_cam):
+            # an own source per camera, the same path twice would be taken as one camera moved
+            source = open_source(args.source[min(pos,len(args.source)-1)],realtime=args.realtime)
+            robot.set_cameras(source,pos)
+        robot.reset()
+
+        for _ in range(args.warmup):
+            robot.step([0])
+
+        step_times,read_times,agent_times = [],[],[]
+        for _ in range(args.steps):
+            st = time.perf_counter()
+            robot.step([0])
+            step_times.append(time.perf_counter()-st)
+
+            st = time.perf_counter()
+            images = robot.cams.read_images()
+            read_times.append(time.perf_counter()-st)
+
+            st = time.perf_counter()
+            robot.agent(list_images=images,maneuver=[0])
+            agent_times.append(time.perf_counter()-st)
+
+        summarize("AVbot.step",step_times)
+        summarize("read_images",read_times)
+        summarize("Agent.__call__",agent_times)
+        frame_gate = getattr(robot.agent.observer,'frame_gate',None)
+        if frame_gate is not None:
+            stats = frame_gate.get_stats()
+            print(f"frame gate     reused {stats['reused']}/{stats['steps']} steps ({stats['reuse_rate']*100:.1f}%)")
+    finally:
+        robot.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,10 @@
 import sys
 import os
 from PyQt5.QtWidgets import QFileDialog, QSlider,QProgressBar,QDialog,QSizePolicy,QApplication, QMainWindow, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QComboBox, QMessageBox, QScrollArea, QGridLayout
-from PyQt5.QtCore import Qt, QThread, pyqtSignal,QTimer,QCoreApplication
+from PyQt5.QtCore import Qt, QThread, pyqtSignal,QTimer,QCoreApplication,QEvent
 from PyQt5.QtGui import QImage, QPixmap
 from system.Robot import AVbot
-import cv2
+from system.modules.discovery import CameraDiscovery
 import serial.tools.list_ports
 import traceback
 import sys
@@ -90,12 +90,15 @@ class PortCheckThread(QThread):
 class LoopThread(QThread):
     image_update = pyqtSignal(list)
     control_update = pyqtSignal(float, float,float,float)  # New signal for steer and throttle
+    camera_update = pyqtSignal(bool)  # camera 0 blank, covered or frozen, every control step
     
     def __init__(self, parent=None):
         super().__init__(parent)
         self.running = False
         self.cmd = [0]
         self.robot = AVbot()
+        # agent vision is rendered on the robot's render thread, not in this loop
+        self.robot.set_vision_callback(self.image_update.emit)
     
     def load_agent(self, zip_path):
         self.robot.init_agent(zip_path)
@@ -106,14 +109,32 @@ class LoopThread(QThread):
         self.image_update.emit([])  # Emit an empty list to clear the display
         self.control_update.emit(0, 0,0,0)
 
+    def camera_blocked(self):
+        """
+        return: camera 0 of the last step is blank, covered or frozen, None before the first read
+        """
+        cams = self.robot.cams
+        images = getattr(self.robot,'images',None)
+        if cams is None or not images:
+            return None
+        # health stats are computed on a subsample in the capture stage
+        health = cams.health[0]
+        if health is None:
+            return camera_blankorcover(images[0],th=45)
+        if health['frozen']:
+            print("camera is frozen")
+        return health['blank_or_cover'] or health['frozen']
+
     def run(self):
         while self.running:
             try:
      
                 steer, throttle,proc_time,ctrled_time = self.robot.step(self.cmd)            
-                images = self.robot.get_vision()
-                self.image_update.emit(images)
                 self.control_update.emit(steer, throttle,proc_time,ctrled_time)  # Emit control values
+                # safety check runs per step here, the display is rate limited
+                blocked = self.camera_blocked()
+                if blocked is not None:
+                    self.camera_update.emit(blocked)
 
             except Exception as e:
                 tb = traceback.format_exc()
@@ -131,6 +152,7 @@ class CarControlGUI(QMainWindow):
         self.loop_thread = LoopThread()
         self.loop_thread.image_update.connect(self.display_images)
         self.loop_thread.control_update.connect(self.update_control_display)
+        self.loop_thread.camera_update.connect(self.update_camera_state)
         self.camera_inputs=[]
         self.n_cam = 0
         self.cmd = [0]
@@ -138,6 +160,7 @@ class CarControlGUI(QMainWindow):
         self.blank_cover_count = 0
         self.camera_blanking = True
         self.port_check_thread = None
+        self.camera_discovery = CameraDiscovery()
 
         self.setWindowTitle("PathRover")
         self.setGeometry(100, 100, 1024, 700)
@@ -457,7 +480,7 @@ class CarControlGUI(QMainWindow):
             QMessageBox.warning(self, "Warning", "Cannot refresh cameras while control is activated.")
             return
 
-        self.populate_camera_combos()
+        self.populate_camera_combos(refresh=True)
         QMessageBox.information(self, "Success", "Camera list has been refreshed.")
 
 
@@ -603,8 +626,8 @@ class CarControlGUI(QMainWindow):
         # Populate the combo boxes with available camera indices
         self.populate_camera_combos()
 
-    def populate_camera_combos(self):
-        available_cameras = self.get_available_cameras()
+    def populate_camera_combos(self,refresh=False):
+        available_cameras = self.get_available_cameras(refresh)
         for combo in self.camera_inputs:
             current_selection = combo.currentText()
             combo.clear()
@@ -614,15 +637,10 @@ class CarControlGUI(QMainWindow):
             else:
                 combo.setCurrentIndex(0)  # Set to "Select" if previous selection is no longer available
 
-    def get_available_cameras(self):
+    def get_available_cameras(self,refresh=False):
         print("checking for camera..")
-        available_cameras = []
-        for i in range(6):  # Check first 10 indices
-            cap = cv2.VideoCapture(i)
-            if cap.isOpened():
-                available_cameras.append(i)
-                cap.release()
-        return available_cameras
+        # parallel probe, cached until the set of video devices changes
+        return self.camera_discovery.discover(refresh=refresh)
 
     def update_camera_indices(self):
 
@@ -644,24 +662,22 @@ class CarControlGUI(QMainWindow):
                 sender.setStyleSheet("background-color: #ffcdd2;")  # Light red background
                 QTimer.singleShot(1000, lambda: sender.setStyleSheet(""))  # Reset after 1 second
                 
-    def display_images(self, images):
+    def update_camera_state(self, blocked):
+        if blocked:
+            self.camera_blanking =True
+            if self.control_activated:
+                self.blank_cover_count+=1
+        else:
+            self.camera_blanking =False
+            if self.control_activated:
+                self.blank_cover_count=0
 
-        if len(images) > 0:
-            if len(images[0]) > 0:
-                if camera_blankorcover(images[0][0],th=45):
-                    self.camera_blanking =True
-                    if self.control_activated:
-                        self.blank_cover_count+=1
-                else:
-                    self.camera_blanking =False
-                    if self.control_activated:
-                        self.blank_cover_count=0
-                
-  
         if self.control_activated and self.blank_cover_count > 1:
             print("camera is blank or cover")
             self.deactivate_control()
 
+    def display_images(self, images):
+
         # Clear the existing layout
         for i in reversed(range(self.scroll_layout.count())): 
             self.scroll_layout.itemAt(i).widget().setParent(None)
@@ -705,6 +721,12 @@ class CarControlGUI(QMainWindow):
         # Update the scroll area
         self.scroll_content.adjustSize()
 
+    def changeEvent(self, event):
+        super().changeEvent(event)
+        # nothing of the agent vision is rendered while the window is minimized
+        if event.type() == QEvent.WindowStateChange and hasattr(self, 'loop_thread'):
+            self.loop_thread.robot.set_vision_visible(not self.isMinimized())
+
     def resizeEvent(self, event):
         super().resizeEvent(event)
         # Recalculate image sizes when the window is resized
@@ -0,0 +1,54 @@
+import time
+import numpy as np
+
+
+def mean_iou(preds,refs,labels):
+    """
+    input: list of predicted seg maps, list of reference seg maps, labels to score
+    return: mIoU over labels present in either map, per label IoU
+    """
+    ious = {}
+    for label in labels:
+        intersection = 0
+        union = 0
+        for pred,ref in zip(preds,refs):
+            pred_mask = np.asarray(pred) == label
+            ref_mask = np.asarray(ref) == label
+            intersection += np.count_nonzero(pred_mask & ref_mask)
+            union += np.count_nonzero(pred_mask | ref_mask)
+        if union > 0:
+            ious[label] = intersection / union
+    miou = float(np.mean(list(ious.values()))) if ious else 1.0
+    return miou,ious
+
+
+def compare_segmenters(reference,candidate,images,batch=1,test_times=None):
+    """
+    run two seg wrappers on the same frames and compare mapped label maps and latency
+
+    input: reference wrapper (e.g. fp32 torch), candidate wrapper, list of RGB frames
+    return: dict with mIoU against the reference, pixel agreement and per frame latency
+    """
+    ref_segs, cand_segs = [], []
+    ref_times, cand_times = [], []
+    images = images[:test_times] if test_times else images
+    for i in range(0,len(images),batch):
+        frames = images[i:i+batch]
+        st = time.time()
+        ref_segs.extend(np.asarray(seg) for seg in reference(frames))
+        ref_times.append((time.time()-st)/len(frames))
+        st = time.time()
+        cand_segs.extend(np.asarray(seg) for seg in candidate(frames))
+        cand_times.append((time.time()-st)/len(frames))
+
+    labels = [0]+list(reference.labels)
+    miou,ious = mean_iou(cand_segs,ref_segs,labels)
+    agreement = float(np.mean([np.mean(c == r) for c,r in zip(cand_segs,ref_segs)]))
+    report = {'miou':miou,
+              'iou_per_label':ious,
+              'pixel_agreement':agreement,
+              'reference_latency':float(np.mean(ref_times)),
+              'candidate_latency':float(np.mean(cand_times))}
+    print(f"mIoU :{miou:.4f} pixel agreement :{agreement:.4f} "
+          f"latency reference :{report['reference_latency']:.6f} candidate :{report['candidate_latency']:.6f}")
+    return report
@@ -0,0 +1,162 @@
+import os
+
+import cv2
+import torch
+from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                      quantize_dynamic, quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from transformers import AutoImageProcessor
+
+from segmentation.preprocess import TensorProcessor
+from segmentation.evaluate import compare_segmenters
+from segmentation.seg_onnx import ONNXsegWrapper, export_onnx
+from segmentation import seg_hf
+
+
+def load_frames(spec,n_frames=64,stride=1):
+    """
+    RGB frames of a recording for calibration / evaluation
+
+    spec: video file, image directory or drive log ("log_dir#1" for camera 1)
+    stride: keep one frame every stride frames
+    """
+    from system.modules.sources import open_source
+    source = open_source(spec,loop=False)
+    frames = []
+    idx = 0
+    try:
+        while len(frames) < n_frames:
+            ret, frame = source.read()
+            if not ret:
+                break
+            if idx % stride == 0:
+                frames.append(cv2.cvtColor(frame,cv2.COLOR_BGR2RGB))
+            idx += 1
+    finally:
+        source.release()
+    return frames
+
+
+class FrameCalibrationReader(CalibrationDataReader):
+    """
+    feeds recorded frames to onnx runtime calibration, cropped and preprocessed like ONNXsegWrapper
+    """
+
+    def __init__(self,export_dir,frames,crop=None):
+        from system.modules.perception import center_crop_box
+        self.processor = TensorProcessor(AutoImageProcessor.from_pretrained(export_dir),torch.device("cpu"))
+        if crop is not None:
+            boxes = [center_crop_box(frame.shape,crop) for frame in frames]
+            frames = [frame[y1:y2,x1:x2] for frame,(y1,y2,x1,x2) in zip(frames,boxes)]
+        self.frames = frames
+        self.idx = 0
+
+    def get_next(self):
+        if self.idx >= len(self.frames):
+            return None
+        pixel_values = self.processor([self.frames[self.idx]])['pixel_values']
+        self.idx += 1
+        return {'pixel_values':pixel_values.numpy().copy()}
+
+    def rewind(self):
+        self.idx = 0
+
+
+def quantize_onnx(onnx_path,mode='dynamic',frames=None,crop=None,per_channel=True):
+    """
+    int8 copy of a model written by export_onnx, next to it so ONNXsegWrapper finds the
+    processor and seg_onnx.json: point seg_model_config onnx_path at the returned path
+
+    mode: 'dynamic' int8 weights of MatMul/Gemm, activations quantized at run time
+          'static' int8 weights and activations (QDQ), activation ranges calibrated on frames
+    frames: RGB frames of a recording (see load_frames), required for static
+    crop: crop of the agent config, frames are cropped like the wrapper does
+    return: path of the quantized model
+    """
+    export_dir = os.path.dirname(onnx_path)
+    output_path = os.path.join(export_dir,f"model_int8_{mode}.onnx")
+    if mode == 'dynamic':
+        quantize_dynamic(onnx_path,output_path,
+                         op_types_to_quantize=['MatMul','Gemm'],
+                         weight_type=QuantType.QInt8,
+                         per_channel=per_channel)
+    elif mode == 'static':
+        if not frames:
+            raise ValueError("static quantization needs calibration frames")
+        # shape inference + graph cleanup so every activation gets a calibrated range
+        preprocessed_path = os.path.join(export_dir,'model_preprocessed.onnx')
+        quant_pre_process(onnx_path,preprocessed_path,skip_symbolic_shape=True)
+        quantize_static(preprocessed_path,output_path,
+                        FrameCalibrationReader(export_dir,frames,crop),
+                        quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        per_channel=per_channel)
+        os.remove(preprocessed_path)
+    else:
+        raise ValueError(f"unknown quantization mode {mode}, use 'dynamic' or 'static'")
+    print(f"{mode} int8 model written to {output_path}")
+    return output_path
+
+
+def quantization_report(seg_model_config,frames,export_dir=None,calibration_frames=None,
+                        modes=None):
+    """
+    mIoU of the mapped labels and per frame latency of the int8 variants against the
+    fp32 torch wrapper of the same agent config
+
+    frames: RGB evaluation frames (see load_frames)
+    export_dir: onnx export dir, exported from seg_model_config when missing, needed for onnx_* modes
+    calibration_frames: frames for static calibration, other frames than the evaluation ones,
+                        required for onnx_static
+    modes: torch_dynamic (HFsegWrapper quantize='dynamic'), onnx_dynamic, onnx_static
+           default all of them, onnx_static only when calibration_frames are given
+    return: {mode: compare_segmenters report}
+    """
+    if modes is None:
+        modes = ('torch_dynamic','onnx_dynamic') + (('onnx_static',) if calibration_frames else ())
+    # check the arguments before the fp32 reference is loaded
+    for mode in modes:
+        if mode not in ('torch_dynamic','onnx_dynamic','onnx_static'):
+            raise ValueError(f"unknown mode {mode}")
+    if 'onnx_static' in modes and not calibration_frames:
+        raise ValueError("onnx_static needs calibration_frames, calibrating on the evaluation frames inflates its mIoU")
+    if any(mode.startswith('onnx') for mode in modes) and export_dir is None:
+        raise ValueError("onnx modes need an export_dir")
+
+    config = dict(seg_model_config['config'])
+    config['fp16'] = False
+    config['torch_compile'] = False
+    config.pop('quantize',None)
+    reference = getattr(seg_hf,seg_model_config['name'])(**config)
+
+    onnx_path = None
+    if any(mode.startswith('onnx') for mode in modes):
+        onnx_path = os.path.join(export_dir,'model.onnx')
+        if not os.path.exists(onnx_path):
+            crop = config.get('crop')
+            image_shape = tuple(crop) if crop else frames[0].shape[:2]
+            export_onnx(seg_model_config,export_dir,image_shape=image_shape)
+
+    reports = {}
+    for mode in modes:
+        print(f"===== {mode} =====")
+        if mode == 'torch_dynamic':
+            candidate = getattr(seg_hf,seg_model_config['name'])(**config,quantize='dynamic')
+        else:
+            quant = mode.split('_')[1]
+            quant_path = quantize_onnx(onnx_path,quant,
+                                       frames=calibration_frames,
+                                       crop=config.get('crop'))
+            candidate = ONNXsegWrapper(quant_path,
+                                       label_mapping=config.get('label_mapping'),
+                                       crop=config.get('crop'),
+                                       custom_palette=config.get('custom_palette'))
+        reports[mode] = compare_segmenters(reference,candidate,frames)
+
+    print(f"{'mode':<14} {'mIoU':>8} {'agreement':>10} {'fp32 ms':>9} {'int8 ms':>9} {'speedup':>8}")
+    for mode,report in reports.items():
+        ref_ms, cand_ms = report['reference_latency']*1000, report['candidate_latency']*1000
+        print(f"{mode:<14} {report['miou']:8.4f} {report['pixel_agreement']:10.4f} "
+              f"{ref_ms:9.2f} {cand_ms:9.2f} {ref_ms/cand_ms:7.2f}x")
+    return reports
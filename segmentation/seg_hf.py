@@ -9,12 +9,36 @@ import torch
 torch.backends.cuda.matmul.allow_tf32 = True
 
 from segmentation.seg_wrapper import SegmodelWrapper
+from segmentation.preprocess import TensorProcessor
+import time
 
 class HFsegWrapper(SegmodelWrapper):
 
     """
     hugging face model with addition method for visulize and predict
+
+    merge_classes: reduce the class scores to the label_mapping groups (background + mapped
+                   labels) before upsampling / argmax, so post process scales with the mapped
+                   labels instead of every model class. requires label_mapping.
+                   'max' / 'logsumexp' reduce per group, Mask2Former also takes 'sum' which
+                   adds the class probabilities of a group before the mask einsum.
+                   'max' gives the same labels as argmax + label mapping only when no resize
+                   follows the merge (Segformer at logits resolution). Mask2Former merges before
+                   the bilinear upsample and max doesn't commute with it, labels differ near class
+                   borders (~96% pixel agreement on synthetic scores), check compare_segmenters
+                   before switching a config. 'sum' / 'logsumexp' pool the scores of a group so the
+                   large background group gains weight.
+                   Segformer labels stay at logits resolution so the gain is mostly for
+                   Mask2Former, where the upsampling to the image size runs on 5 groups instead of 65 classes
+    output_size: (h,w) of the returned seg maps, e.g. the VAE input (245,245), instead of the
+                 (cropped) image size. labels are never blended (nearest / argmax at that size),
+                 get_seg_images upsamples for display only
+    tensor_output: return the seg maps as one (batch,h,w) uint8 tensor left on the model device,
+                   for a device resident seg -> VAE path (VencoderWrapper takes the tensor)
+    warmup_batch: frames of the warmup pass (number of cameras), 0 skips warmup
     """
+
+    merge_modes = ()
    
     def __init__(self,
                  model_repo,
@@ -23,7 +47,13 @@ class HFsegWrapper(SegmodelWrapper):
                  custom_processor=None,
                  custom_palette=None,
                  fp16 = False,
-                 torch_compile = False):
+                 torch_compile = False,
+                 fast_processor = False,
+                 quantize = None,
+                 merge_classes = None,
+                 output_size = None,
+                 tensor_output = False,
+                 warmup_batch = 1):
 
         super().__init__()
         if label_mapping is not None:
@@ -32,8 +62,19 @@ class HFsegWrapper(SegmodelWrapper):
         if crop is not None:
             assert len(crop) == 2
 
+        if output_size is not None:
+            assert len(output_size) == 2
+
+        if merge_classes is not None:
+            assert label_mapping is not None, "merge_classes needs a label_mapping"
+            assert merge_classes in self.merge_modes, f"merge_classes must be one of {self.merge_modes}"
+
+        if quantize is not None:
+            assert quantize == 'dynamic', "torch backend only supports dynamic quantization, use segmentation.quantize for static int8"
+
         print('===== Segmentation =====')
-        self.device  = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # int8 kernels of quantize_dynamic are cpu only
+        self.device  = torch.device("cuda" if torch.cuda.is_available() and quantize is None else "cpu")
         print("using ",self.device)
 
         self.torch_dtype = torch.float16 if fp16 and self.device.type == "cuda" else torch.float32
@@ -41,13 +82,95 @@ class HFsegWrapper(SegmodelWrapper):
         self.crop = crop
         self.label_mapping = label_mapping
         self.custom_processor = custom_processor
+        self.merge_classes = merge_classes
+        self.output_size = tuple(output_size) if output_size is not None else None
+        self.tensor_output = tensor_output
         self.processor,self.model = self._init_preprocess_model(model_repo)
+        # torch resize/normalize into a reused tensor instead of the PIL based HF processor
+        self.fast_processor = TensorProcessor(self.processor,self.device,self.torch_dtype) \
+                                if fast_processor and custom_processor is None else None
+
+        if quantize == 'dynamic':
+            # int8 weights, activations quantized on the fly, for every nn.Linear
+            self.model = torch.ao.quantization.quantize_dynamic(self.model,{torch.nn.Linear},dtype=torch.qint8)
         
         if torch_compile:
             self.model = torch.compile(self.model)
         self.default_numlabels = self.model.config.num_labels
         self.apply_label_mapping(label_mapping,custom_palette)
-        self.warmup()
+
+        self.model_id = model_repo
+        self.backend = "-".join([type(self).__name__,str(self.device),str(self.torch_dtype).split('.')[-1]]
+                                +[option for option,on in [('int8',quantize),('compiled',torch_compile),
+                                                           ('fastproc',self.fast_processor is not None),
+                                                           (f'merge_{merge_classes}',merge_classes),
+                                                           (f'out{output_size[0]}x{output_size[1]}' if output_size else '',output_size)] if on])
+        if warmup_batch:
+            self.warmup(batch=warmup_batch)
+
+    def _build_luts(self):
+        super()._build_luts()
+        # label mapping is fused with the argmax in _get_segmaps, on the model device
+        self.label_lut_t = torch.from_numpy(self.label_lut).to(self.device) \
+                            if self.label_mapping is not None else None
+
+        # class -> group index (0 is background), group index -> mapped label
+        self.merge_labels = [0]+sorted(self.labels) if self.label_mapping is not None else None
+        if self.merge_classes is not None:
+            groups = [self.merge_labels.index(label) for label in self.label_lut[:self.default_numlabels]]
+            self.class_groups = torch.tensor(groups,dtype=torch.long,device=self.device)
+            self.group_lut_t = torch.tensor(self.merge_labels,dtype=torch.uint8,device=self.device)
+
+    def _merge_class_scores(self, scores, dim=1, reduce=None):
+        """
+        input: scores with the model classes on dim
+        return: scores with the merge_labels groups on dim, reduced with reduce (default merge_classes)
+        """
+        reduce = reduce or self.merge_classes
+        index_shape = [1]*scores.dim()
+        index_shape[dim] = -1
+        index = self.class_groups.view(index_shape).expand_as(scores)
+        shape = list(scores.shape)
+        shape[dim] = len(self.merge_labels)
+        if reduce == 'sum':
+            return scores.new_zeros(shape).scatter_add_(dim,index,scores)
+        if reduce == 'logsumexp':
+            peak = scores.amax(dim=dim,keepdim=True)
+            merged = scores.new_zeros(shape).scatter_add_(dim,index,(scores-peak).exp_())
+            return merged.log_().add_(peak)
+        return scores.new_full(shape,float('-inf')).scatter_reduce_(dim,index,scores,'amax',include_self=False)
+
+    def _target_sizes(self):
+        return [self.output_size or image.shape[:-1] for image in self.images]
+
+    def _resize_labels(self, seg):
+        """
+        input: (batch,h,w) label tensor
+        return: labels nearest resized to output_size (if set)
+        """
+        if self.output_size is None or tuple(seg.shape[-2:]) == self.output_size:
+            return seg
+        labels = seg.unsqueeze(1)
+        # uint8 nearest is supported, int64 argmax labels go through float
+        resized = torch.nn.functional.interpolate(labels if labels.dtype == torch.uint8 else labels.float(),
+                                                  size=self.output_size,mode='nearest-exact')
+        return resized.squeeze(1).to(seg.dtype)
+
+    def _output_segmaps(self, seg_maps):
+        """
+        input: (batch,h,w) label tensor on the model device
+        return: the tensor with tensor_output, else list of numpy seg maps
+        """
+        if self.tensor_output:
+            return seg_maps.to(torch.uint8)
+        return list(seg_maps.cpu().numpy())
+
+    def _map_labels(self, seg):
+        """
+        input: argmax label tensor on the model device
+        return: mapped uint8 labels if label_mapping is set, else seg
+        """
+        return self.label_lut_t[seg] if self.label_lut_t is not None else seg
 
     def _init_preprocess_model(self, repo):
         """
@@ -67,34 +190,54 @@ class HFsegWrapper(SegmodelWrapper):
     def __call__(self,images):
 
         """
-        inputs: list of images
-        return predict output and overlayed image
+        inputs: list of images, images already at crop size (RGBCams roi) are used as is
+        return predict output, already mapped with label_mapping by _get_segmaps
         """
-        if self.crop is not None:
-            h,w = self.crop
-            shape = images[0].shape
-            y1,y2, x1,x2 = max(int(shape[0]/2-h/2),0), min(int(shape[0]/2+h/2),shape[0]), max(int(shape[1]/2-w/2),0), min(int(shape[1]/2+w/2),shape[1])
-            self.images = [img[y1:y2,x1:x2] for img in images]
-        else:
-            self.images = images
+        self.images = self.crop_images(images)
 
         with torch.no_grad():
-            if self.custom_processor is None:
+            if self.fast_processor is not None:
+                inputs = self.fast_processor(self.images)
+            elif self.custom_processor is None:
                 inputs = self.processor(self.images,return_tensors="pt").to(self.device,self.torch_dtype)
             else:
-                inputs = {'pixel_values':self.processor(torch.stack([self.processor(img) for img in self.images],axis=0))}.to(self.device,self.torch_dtype)
+                inputs = {'pixel_values':torch.stack([self.processor(img) for img in self.images]).to(self.device,self.torch_dtype)}
 
             self.outputs = self.model(**inputs)
 
         pred_segs = self._get_segmaps(self.outputs)
-        
-        if self.label_mapping is not None:
-            pred_segs = self.convert_label(pred_segs)  
 
         return pred_segs
+
+    def benchmark_processor(self,image_shape=(640,1280,3),batch=1,test_times=20):
+        """
+        compare the HF processor with TensorProcessor: latency and max abs difference
+        of pixel_values (expected < 0.05, about 1 uint8 level after normalize)
+        """
+        images = [np.random.randint(0, 255, image_shape, dtype=np.uint8) for _ in range(batch)]
+        fast_processor = self.fast_processor or TensorProcessor(self.processor,self.device,self.torch_dtype)
+
+        hf_values = self.processor(images,return_tensors="pt")['pixel_values'].to(self.device,self.torch_dtype)
+        fast_values = fast_processor(images)['pixel_values']
+        max_diff = (hf_values.float()-fast_values.float()).abs().max().item()
+
+        results = {}
+        for name,process in [('hf',lambda: self.processor(images,return_tensors="pt").to(self.device,self.torch_dtype)),
+                             ('fast',lambda: fast_processor(images))]:
+            st = time.time()
+            for _ in range(test_times):
+                process()
+            if self.device.type == "cuda":
+                torch.cuda.synchronize()
+            results[name] = (time.time()-st)/test_times
+        print(f"preprocess hf :{results['hf']:.6f} fast :{results['fast']:.6f} max diff :{max_diff:.6f}")
+        results['max_diff'] = max_diff
+        return results
     
     
 class HF_segFormermodel(HFsegWrapper):
+
+    merge_modes = ('max','logsumexp')
    
     def __init__(self, *args, **kwargs):
         # Call the parent constructor with all arguments
@@ -115,13 +258,22 @@ class HF_segFormermodel(HFsegWrapper):
         input: preds
         return: segmaps, preds
         """
-        return preds.logits.argmax(dim=1).cpu()
+        if self.merge_classes is not None:
+            seg_maps = self._merge_class_scores(preds.logits).argmax(dim=1)
+            return self._output_segmaps(self._resize_labels(self.group_lut_t[seg_maps]))
+
+        seg_maps = preds.logits.argmax(dim=1)
+        if self.label_lut_t is None and not self.tensor_output:
+            return self._resize_labels(seg_maps).cpu()
+        return self._output_segmaps(self._resize_labels(self._map_labels(seg_maps)))
   
     
          
     
 
 class HF_mask2Formermodel(HFsegWrapper):
+
+    merge_modes = ('sum','max','logsumexp')
    
     def __init__(self, *args, **kwargs):
         # Call the parent constructor with all arguments
@@ -143,13 +295,40 @@ class HF_mask2Formermodel(HFsegWrapper):
         input: preds
         return: segmaps, preds
         """
+        if self.merge_classes is not None:
+            return self._get_merged_segmaps(preds)
+
         seg_maps = self.processor.post_process_semantic_segmentation(preds,
-                                                                 target_sizes=[image.shape[:-1] for image in self.images]
+                                                                 target_sizes=self._target_sizes()
                                                                     )
 
-        seg_maps = [seg.cpu().numpy().astype(np.uint8) for seg in seg_maps]
-        return seg_maps
+        seg_maps = torch.stack([self._map_labels(seg) for seg in seg_maps]).to(torch.uint8)
+        return self._output_segmaps(seg_maps)
   
 
 
-  
\ No newline at end of file
+  
+
+    def _get_merged_segmaps(self, preds):
+        """
+        post_process_semantic_segmentation with the classes merged into the label_mapping
+        groups before the einsum ('sum') or before upsampling to the image size
+        return: mapped uint8 seg maps
+        """
+        # same (384,384) mask resolution as the HF post process
+        masks_probs = torch.nn.functional.interpolate(preds.masks_queries_logits,size=(384, 384),
+                                                      mode="bilinear",align_corners=False).sigmoid()
+        masks_classes = preds.class_queries_logits.softmax(dim=-1)[..., :-1]
+        if self.merge_classes == 'sum':
+            masks_groups = self._merge_class_scores(masks_classes,dim=-1)
+            segmentation = torch.einsum("bqg, bqhw -> bghw", masks_groups, masks_probs)
+        else:
+            segmentation = torch.einsum("bqc, bqhw -> bchw", masks_classes, masks_probs)
+            segmentation = self._merge_class_scores(segmentation,dim=1)
+
+        seg_maps = []
+        for idx,size in enumerate(self._target_sizes()):
+            resized = torch.nn.functional.interpolate(segmentation[idx].unsqueeze(dim=0),size=size,
+                                                      mode="bilinear",align_corners=False)
+            seg_maps.append(self.group_lut_t[resized[0].argmax(dim=0)])
+        return self._output_segmaps(torch.stack(seg_maps))
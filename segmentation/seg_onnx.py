@@ -0,0 +1,205 @@
+import os
+import json
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+import onnxruntime as ort
+from transformers import AutoImageProcessor
+
+from segmentation.seg_wrapper import SegmodelWrapper
+from segmentation.preprocess import TensorProcessor
+from segmentation.evaluate import compare_segmenters
+from segmentation import seg_hf
+
+# outputs kept from each HF model, in onnx output order
+MODEL_OUTPUTS = {'HF_segFormermodel':['logits'],
+                 'HF_mask2Formermodel':['class_queries_logits','masks_queries_logits']}
+
+META_FILE = 'seg_onnx.json'
+
+
+class _ExportModule(torch.nn.Module):
+    """
+    HF model returning a plain tuple of tensors for torch.onnx.export
+    """
+
+    def __init__(self,model,output_names):
+        super().__init__()
+        self.model = model
+        self.output_names = output_names
+
+    def forward(self,pixel_values):
+        outputs = self.model(pixel_values=pixel_values)
+        return tuple(getattr(outputs,name) for name in self.output_names)
+
+
+def export_onnx(seg_model_config,export_dir,image_shape=(512,1024),opset=17):
+    """
+    export the HF seg model of an agent config to onnx
+
+    seg_model_config: 'seg_model_config' of the agent config (name: HF_* class, config)
+    image_shape: (h,w) of the frames fed to the model when config has no crop
+    writes export_dir/model.onnx, the HF processor config and seg_onnx.json
+    return: onnx path
+    """
+    name = seg_model_config['name']
+    if name not in MODEL_OUTPUTS:
+        raise ValueError(f"{name} can't be exported, supported: {list(MODEL_OUTPUTS)}")
+    config = dict(seg_model_config['config'])
+    config['fp16'] = False
+    config['torch_compile'] = False
+    config.pop('quantize',None)
+    wrapper = getattr(seg_hf,name)(**config)
+
+    crop = config.get('crop') or image_shape
+    processor = TensorProcessor(wrapper.processor,torch.device("cpu"))
+    dummy = processor([np.zeros((crop[0],crop[1],3),dtype=np.uint8)])['pixel_values'].clone()
+
+    os.makedirs(export_dir,exist_ok=True)
+    onnx_path = os.path.join(export_dir,'model.onnx')
+    output_names = MODEL_OUTPUTS[name]
+    module = _ExportModule(wrapper.model.float().cpu().eval(),output_names)
+    with torch.no_grad():
+        torch.onnx.export(module,(dummy,),onnx_path,
+                          input_names=['pixel_values'],
+                          output_names=output_names,
+                          dynamic_axes={'pixel_values':{0:'batch'},**{o:{0:'batch'} for o in output_names}},
+                          opset_version=opset,
+                          dynamo=False)
+
+    wrapper.processor.save_pretrained(export_dir)
+    meta = {'source':name,
+            'model_repo':config.get('model_repo'),
+            'num_labels':wrapper.default_numlabels,
+            'outputs':output_names,
+            'input_shape':list(dummy.shape)}
+    with open(os.path.join(export_dir,META_FILE),'w') as file:
+        json.dump(meta,file,indent=4)
+    print(f"exported {name} to {onnx_path}")
+    return onnx_path
+
+
+class ONNXsegWrapper(SegmodelWrapper):
+
+    """
+    onnx runtime backend for models written by export_onnx, runs on cpu only boxes
+
+    select it in the agent config with seg_model_config name "ONNXsegWrapper" and
+    config onnx_path plus the usual label_mapping / crop / custom_palette.
+    onnx_path can also be an int8 model written by segmentation.quantize.quantize_onnx.
+    output_size: (h,w) of the returned seg maps, see HFsegWrapper
+    warmup_batch: frames of the warmup pass (number of cameras), 0 skips warmup
+
+    intra_op_threads, inter_op_threads: onnx runtime thread pools, 0 lets ort decide
+    io_binding: bind the preprocessed input and outputs instead of session.run copies
+    providers: onnx runtime execution providers, default cpu
+    """
+
+    def __init__(self,
+                 onnx_path,
+                 label_mapping=None,
+                 crop=None,
+                 custom_palette=None,
+                 intra_op_threads=0,
+                 inter_op_threads=0,
+                 io_binding=True,
+                 providers=None,
+                 output_size=None,
+                 warmup_batch=1):
+
+        super().__init__()
+        if label_mapping is not None:
+            assert isinstance(label_mapping,dict)
+
+        if crop is not None:
+            assert len(crop) == 2
+
+        print('===== Segmentation (onnx) =====')
+        export_dir = os.path.dirname(onnx_path)
+        with open(os.path.join(export_dir,META_FILE),'r') as file:
+            self.meta = json.load(file)
+
+        sess_options = ort.SessionOptions()
+        sess_options.intra_op_num_threads = intra_op_threads
+        sess_options.inter_op_num_threads = inter_op_threads
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path,sess_options,
+                                            providers=providers or ['CPUExecutionProvider'])
+        print("using ",self.session.get_providers())
+
+        self.device = torch.device("cpu")
+        self.crop = crop
+        self.output_size = tuple(output_size) if output_size is not None else None
+        self.io_binding = io_binding
+        self.output_names = self.meta['outputs']
+        self.processor = AutoImageProcessor.from_pretrained(export_dir)
+        self.fast_processor = TensorProcessor(self.processor,self.device)
+        self.default_numlabels = self.meta['num_labels']
+        self.apply_label_mapping(label_mapping,custom_palette)
+
+        self.model_id = os.path.abspath(onnx_path)
+        self.backend = "-".join(['onnx']+self.session.get_providers()
+                                +[f'threads{intra_op_threads}'] +(['iobinding'] if io_binding else [])
+                                +([f'out{output_size[0]}x{output_size[1]}'] if output_size else []))
+        if warmup_batch:
+            self.warmup(batch=warmup_batch)
+
+    def _run(self,pixel_values):
+        if not self.io_binding:
+            return self.session.run(self.output_names,{'pixel_values':pixel_values})
+        binding = self.session.io_binding()
+        binding.bind_cpu_input('pixel_values',pixel_values)
+        for name in self.output_names:
+            binding.bind_output(name)
+        self.session.run_with_iobinding(binding)
+        return binding.copy_outputs_to_cpu()
+
+    def _get_segmaps(self,outputs):
+        if self.meta['source'] == 'HF_segFormermodel':
+            seg_maps = outputs[0].argmax(axis=1)
+            if self.output_size is None:
+                return seg_maps
+            # labels are mapped after, keep them in a dtype cv2 can resize
+            return [cv2.resize(seg.astype(np.uint16),self.output_size[::-1],interpolation=cv2.INTER_NEAREST_EXACT)
+                    for seg in seg_maps]
+
+        preds = SimpleNamespace(class_queries_logits=torch.from_numpy(outputs[0]),
+                                masks_queries_logits=torch.from_numpy(outputs[1]))
+        seg_maps = self.processor.post_process_semantic_segmentation(preds,
+                                                                 target_sizes=[self.output_size or image.shape[:-1] for image in self.images])
+        return [seg.numpy().astype(np.uint8) for seg in seg_maps]
+
+    def __call__(self,images):
+
+        """
+        inputs: list of images
+        return predict output
+        """
+        self.images = self.crop_images(images)
+        pixel_values = self.fast_processor(self.images)['pixel_values'].numpy()
+        self.outputs = self._run(pixel_values)
+
+        pred_segs = self._get_segmaps(self.outputs)
+
+        if self.label_mapping is not None:
+            pred_segs = self.convert_label(pred_segs)
+
+        return pred_segs
+
+
+def check_against_torch(seg_model_config,onnx_path,images,**onnx_kwargs):
+    """
+    compare ONNXsegWrapper with the torch fp32 wrapper of the same agent config
+    return: report of compare_segmenters (mIoU, pixel agreement, latency)
+    """
+    config = dict(seg_model_config['config'])
+    config['fp16'] = False
+    reference = getattr(seg_hf,seg_model_config['name'])(**config)
+    candidate = ONNXsegWrapper(onnx_path,
+                               label_mapping=config.get('label_mapping'),
+                               crop=config.get('crop'),
+                               custom_palette=config.get('custom_palette'),
+                               **onnx_kwargs)
+    return compare_segmenters(reference,candidate,images)
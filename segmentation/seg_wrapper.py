@@ -2,7 +2,8 @@
 import numpy as np
 import cv2
 import colorsys
-import time
+
+from wrapper.timing_cache import timed_warmup,timed_benchmark
 
 class SegmodelWrapper():
 
@@ -14,14 +15,17 @@ class SegmodelWrapper():
     
     Requirements:
     - Initialization with device setup
+    - model_id and backend attributes, keys of the timing cache
     - Application of label mapping with apply_label_mapping(label_mapping, custom_palette) after initialization
     
     Methods:
-    - warmup(image_shape=(512,1024,3)): Perform inference and print the average time.
+    - crop_images(images): Center crop to self.crop.
+    - warmup(image_shape=None, batch=1): One inference at the crop shape, print the cached timing.
+    - benchmark(image_shape=None, batch=1, test_times=5): Timing loop, stored in the timing cache.
     - generate_colors(num_classes): Generate color for labels.
     - apply_label_mapping(label_mapping, custom_palette=None): Apply label mapping for post-processing.
     - predict(images): Abstract method to be implemented in subclasses.
-    - convert_label(seg_maps): Convert original semantic map to desired semantic map based on label_mapping.
+    - convert_label(seg_maps): Convert original semantic map to desired semantic map based on label_mapping (one lookup table gather).
     - get_seg_overlay(images, segs, original_size=True): Get the image overlay results.
     - get_seg_images(segs, shape=None): Get the segmentation results as colored images.
     """
@@ -32,15 +36,41 @@ class SegmodelWrapper():
         pass
 
 
-    def warmup(self,image_shape=(512,1024,3),batch=1):
-        # warmup
+    def crop_images(self,images):
+        """
+        center crop to self.crop, images already at crop size (RGBCams roi) are used as is
+        """
+        if self.crop is None or images[0].shape[:2] == tuple(self.crop):
+            return images
+        h,w = self.crop
+        shape = images[0].shape
+        y1,y2, x1,x2 = max(int(shape[0]/2-h/2),0), min(int(shape[0]/2+h/2),shape[0]), max(int(shape[1]/2-w/2),0), min(int(shape[1]/2+w/2),shape[1])
+        return [img[y1:y2,x1:x2] for img in images]
+
+    def _warmup_shape(self,image_shape):
+        if image_shape is not None:
+            return tuple(image_shape)
+        return tuple(self.crop)+(3,) if self.crop is not None else (512,1024,3)
+
+    def warmup(self,image_shape=None,batch=1):
+        """
+        one pass at the deployment shape (crop, batch = number of cameras), prints the
+        latency cached by benchmark() for this model / backend / shape on this machine
+        """
+        image_shape = self._warmup_shape(image_shape)
         dummy_images = [np.random.randint(0, 255, image_shape, dtype=np.uint8)]*batch
-        self(dummy_images)
-        test_times = 5
-        st = time.time()
-        for _ in range(test_times):
-            self(dummy_images)
-        print(f"inference time :{(time.time()-st)/test_times:.6f}")
+        segs = timed_warmup(lambda: self(dummy_images),self.model_id,self.backend,(batch,)+image_shape)
+        # seg map shape the next stage (vae) gets
+        self.output_shape = tuple(segs[0].shape)
+
+    def benchmark(self,image_shape=None,batch=1,test_times=5):
+        """
+        timing loop at the deployment shape, stored in the timing cache
+        return: mean seconds per call
+        """
+        image_shape = self._warmup_shape(image_shape)
+        dummy_images = [np.random.randint(0, 255, image_shape, dtype=np.uint8)]*batch
+        return timed_benchmark(lambda: self(dummy_images),self.model_id,self.backend,(batch,)+image_shape,test_times)
 
     @staticmethod
     def generate_colors(num_classes):
@@ -61,7 +91,23 @@ class SegmodelWrapper():
         self.label_mapping = label_mapping
         self.palette = custom_palette if custom_palette and len(custom_palette) >= num_labels \
             else self.generate_colors(num_labels)
+        self._build_luts()
 
+    def _build_luts(self):
+        """
+        label_lut: model label -> mapped label, unmapped labels are background (0)
+        color_lut: label -> palette color, background black
+        both cover every model label (at least 256 entries) so mapping / coloring is a single gather
+        """
+        size = max(256,self.default_numlabels)
+        self.label_lut = np.zeros(size,dtype=np.uint8)
+        if self.label_mapping is not None:
+            for k,v in self.label_mapping.items():
+                self.label_lut[int(k)] = v
+        self.color_lut = np.zeros((size,3),dtype=np.uint8)
+        for j, label in enumerate(self.labels):
+            self.color_lut[label] = self.palette[j]
+        self.color_lut[0] = 0
 
     def __call__(self,images):
 
@@ -77,29 +123,20 @@ class SegmodelWrapper():
         raise NotImplementedError("Method 'predict' must be implemented in subclasses")
     
     def convert_label(self,seg_maps):
-
+        """
+        map model labels to label_mapping labels through label_lut
+        """
         new_segmaps = []
-
         for seg_map in seg_maps:
-
-            # postprocessed = np.full(seg_map.shape,255, dtype=np.uint8)
-            postprocessed = np.zeros(seg_map.shape, dtype=np.uint8)
-
-            for k,v in self.label_mapping.items():
-                # print(f"k: {k}, type: {type(k)}")
-                # print(f"seg_map shape: {seg_map.shape}, dtype: {seg_map.dtype}")
-                postprocessed[seg_map == int(k)] = v
-
-            new_segmaps.append(postprocessed)
-
+            seg_map = np.asarray(seg_map)
+            if seg_map.dtype == np.uint8 and len(self.label_lut) == 256:
+                new_segmaps.append(cv2.LUT(seg_map,self.label_lut))
+            else:
+                new_segmaps.append(np.take(self.label_lut,seg_map))
         return new_segmaps
     
     def _create_color_seg(self, segs: np.ndarray) -> np.ndarray:
-        color_seg = np.zeros((segs.shape[0], segs.shape[1], 3), dtype=np.uint8)
-        for j, label in enumerate(self.labels):
-            color_seg[segs == label, :] = self.palette[j]
-        color_seg[segs == 0, :] = [0, 0, 0]
-        return color_seg
+        return np.take(self.color_lut,np.asarray(segs),axis=0)
          
     def get_seg_overlay(self, images: list, segs: list, original_size: bool = True) -> list:
         if len(images) != len(segs):
@@ -120,12 +157,12 @@ class SegmodelWrapper():
             overlay_images.append(overlay.astype(np.uint8))
         return overlay_images
 
-    def get_seg_images(self, segs: list, shape: tuple = None) -> list:
+    def get_seg_images(self, segs: list, shape: tuple = None, interpolation: int = cv2.INTER_LINEAR) -> list:
         seg_images = []
         for seg in segs:
             color_seg = self._create_color_seg(seg)
             if shape is not None:
-                color_seg = cv2.resize(color_seg, shape)
+                color_seg = cv2.resize(color_seg, shape, interpolation=interpolation)
             seg_images.append(color_seg.astype(np.uint8))
         return seg_images
     
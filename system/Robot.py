@@ -2,12 +2,23 @@ import time
 
 from .modules.agent import Agent
 from .modules.control import SerialControl,CalibrationBox
-from .modules.perception import RGBCams
+from .modules.perception import RGBCams,Recorder
+from .modules.drivelog import DriveLogger
+from .modules.render import VisionRenderer
 
 class AVbot:
 
-    def __init__(self):
+    def __init__(self,cam_config=None,vision_config=None):
+        # extra RGBCams options e.g. {'grabber':True}, roi=True takes the agent's seg crop
+        self.cam_config = cam_config or {}
+        # agent vision display, {'rate': max renders per second (None every step)}
+        self.vision_config = vision_config or {}
+        self.vision_callback = None
+        self.vision_visible = True
+        self.renderer = None
         self.cams = None
+        self.recorder = None
+        self.drive_logger = None
         self.ctrl = SerialControl(None)
         self.calib = CalibrationBox()
         self.agent = None
@@ -20,9 +31,28 @@ class AVbot:
 
     def init_agent(self,model_path):
         self.agent = Agent(model_path)
-        self.cams = RGBCams(self.agent.n_cam,*self.agent.resolution)
+        cam_config = dict(self.cam_config)
+        if cam_config.get('roi') is True:
+            cam_config['roi'] = self.agent.crop
+        self.cams = RGBCams(self.agent.n_cam,*self.agent.resolution,**cam_config)
         self.delta_frame = self.agent.delta_frame
         # self.delta_frame=0.4
+        self.renderer = VisionRenderer(self.agent,callback=self.vision_callback,**self.vision_config)
+        self.renderer.set_visible(self.vision_visible)
+
+    def set_vision_callback(self,callback):
+        """
+        callback: called from the render thread with [camera frames]+agent vision
+        """
+        self.vision_callback = callback
+        if self.renderer is not None:
+            self.renderer.callback = callback
+
+    def set_vision_visible(self,visible):
+        # hidden display, only camera frames are passed to the callback
+        self.vision_visible = visible
+        if self.renderer is not None:
+            self.renderer.set_visible(visible)
 
     def set_cameras(self,cam_idx,pos):
         if self.cams is not None:
@@ -51,9 +81,14 @@ class AVbot:
         steer,throttle,proc_time,ctrled_time = 0,0,-1,-1
         if self.agent is not None and self.cams is not None:
             st_time = time.time()
+            capture_start = time.monotonic()
             self.images = self.cams.read_images()
+            capture_end = time.monotonic()
+            if self.recorder is not None:
+                self.recorder.add_images(self.images)
             if self.calibrating == 0:
                 steer,throttle,brake = self.agent(list_images=self.images,maneuver=maneuver)
+                policy_end = time.monotonic()
             elif self.calibrating ==1:
                 steer,throttle,brake = 0,0.35,False
             elif self.calibrating ==2:
@@ -75,12 +110,53 @@ class AVbot:
             
             if self.activated_ctrl:
                 self.ctrl.send(steer=steer,throttle=throttle)
+
+            if self.drive_logger is not None and self.calibrating == 0:
+                observer = self.agent.observer
+                self.drive_logger.log(frames=self.images,
+                                      segs=observer.seg_maps(),
+                                      latent=observer.cat_latent,
+                                      maneuver=maneuver,
+                                      action=self.agent.previous_action,
+                                      timestamps=[capture_start,capture_end,self.agent.perception_end,
+                                                  policy_end,time.monotonic()])
+
+            if self.renderer is not None:
+                # the agent vision of calibration steps is stale, only the frames are shown
+                self.renderer.submit(self.images,agent_vision=self.calibrating == 0)
         else:
             print("agent or cams is None")
             
         return steer,throttle,proc_time,ctrled_time
 
+    def start_recording(self,video_path,fps=None):
+        self.stop_recording()
+        # pooled camera frames are reused after pool_size-1 reads, the recorder copies them in time
+        pool_size = self.cams.pool_size if self.cams is not None else None
+        self.recorder = Recorder(video_path,fps=fps or 1/self.delta_frame,
+                                 valid_reads=pool_size-1 if pool_size else None)
+        self.recorder.start_recording()
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.stop_recording()
+            self.recorder = None
+
+    def start_drive_log(self,log_dir):
+        self.stop_drive_log()
+        self.drive_logger = DriveLogger(log_dir)
+
+    def stop_drive_log(self):
+        if self.drive_logger is not None:
+            self.drive_logger.close()
+            self.drive_logger = None
+
     def get_vision(self):
+        """
+        return: last rendered [camera frames]+agent vision, doesn't wait for the render thread
+        """
+        if self.renderer is not None:
+            return self.renderer.get() or [self.images]
 
         agent_vision = self.agent.render() 
 
@@ -97,11 +173,16 @@ class AVbot:
 
     def close(self):
         # self.stop()
+        self.stop_recording()
+        self.stop_drive_log()
         self.ctrl.close()
         if self.cams is not None:
             self.cams.close()
+        if self.renderer is not None:
+            self.renderer.close()
         if self.agent is not None:
             self.agent.close()
         self.cams = None
+        self.renderer = None
         self.agent = None
 
@@ -1,18 +1,24 @@
 import os
 import json
 from wrapper.utils import init_component
-import stable_baselines3
-import sb3_contrib
+from wrapper.model_store import apply_manifest
+from .policy import PolicyEngine,load_exported_policy,load_sb3
 import torch
 import gc
+import time
 import traceback
 
 class Agent:
 
-    def __init__(self,model_path):
+    def __init__(self,model_path,verify_policy=False):
+        """
+        verify_policy: compare the policy engine with model.predict at load (tests/test_policy_engine.py
+                       covers the supported policies)
+        """
         self.observer = None
         self.action_wrapper = None
         self.model = None
+        self.policy = None
 
         try:
             model_dir = os.path.dirname(model_path)
@@ -22,10 +28,16 @@ class Agent:
             with open(config_path, 'rb') as file:
                 loaded_config = json.load(file)
             loaded_env_config = loaded_config['env']
+            selected_path = model_path
+            # offline model store (python -m wrapper.model_store import <model_path>)
+            model_path = apply_manifest(model_path,loaded_env_config)
             self.n_cam = len(loaded_env_config['env_config']['cam_config_list'])
             self.delta_frame = loaded_env_config['env_config']['carla_setting']['delta_frame']
             cam_attribute = loaded_env_config['env_config']['cam_config_list'][0]['attribute']
             self.resolution = (cam_attribute['image_size_x'],cam_attribute['image_size_y'])
+            # segmentation center crop, RGBCams can apply it at capture as roi
+            seg_model_config = loaded_env_config['observer_config']['config'].get('seg_model_config',{})
+            self.crop = seg_model_config.get('config',{}).get('crop')
             if "Vae" in loaded_env_config['observer_config']['name']:
                 if loaded_env_config.get('observer_config', {}).get('config').get('vae_decoder_config') is None:
                     vencoder_model_path = loaded_env_config['observer_config']['config']['vae_encoder_config']['model_path']
@@ -44,16 +56,22 @@ class Agent:
 
             # load agent
             algo_name = loaded_config['algorithm']['method']
+            self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+            # exported actor of this zip (python -m system.modules.policy <model_path>), no SB3 import
+            self.policy = load_exported_policy(selected_path,model_path)
+            if self.policy is not None:
+                print(f"running {algo_name} policy exported from {selected_path}")
+                return
 
+            self.model = load_sb3(model_path, algo_name, self.device)
             try:
-                algo = getattr(stable_baselines3, algo_name)
-            except AttributeError:
-                try:
-                    algo = getattr(sb3_contrib, algo_name)
-                except AttributeError:
-                    raise ValueError(f"{algo_name} is not found in both stable_baselines3 and sb3_contrib")
-            self.device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-            self.model = algo.load(model_path, device=self.device)
+                self.policy = PolicyEngine(self.model)
+                if verify_policy:
+                    self.policy.verify(self.model)
+            except (NotImplementedError,AssertionError) as e:
+                print(f"policy engine not used, running model.predict: {e}")
+                self.policy = None
 
         except Exception as e:
             tb = traceback.format_exc()
@@ -66,8 +84,11 @@ class Agent:
         self.observer.reset(list_images)
         self.previous_action = [0,0]
     
-    def render(self):
-        displays = self.observer.get_renders()
+    def render(self,state=None):
+        """
+        state: observer.render_state() of a step, default the last step
+        """
+        displays = self.observer.get_renders(state)
         return displays
 
     def __call__(self,list_images,maneuver):
@@ -83,8 +104,12 @@ class Agent:
                             imgs = list_images,
                             act=self.previous_action,
                             maneuver=maneuver)
+        self.perception_end = time.monotonic()
         
-        self.previous_action,_ = self.model.predict(obs.reshape((1,self.observer.len_latent)) ,deterministic=True)
+        if self.policy is not None:
+            self.previous_action,_ = self.policy.predict(obs.reshape((1,self.observer.len_latent)))
+        else:
+            self.previous_action,_ = self.model.predict(obs.reshape((1,self.observer.len_latent)) ,deterministic=True)
 
         action = self.action_wrapper(self.previous_action)
 
@@ -97,6 +122,7 @@ class Agent:
         if self.action_wrapper is not None:
             del self.action_wrapper
             self.action_wrapper = None
+        self.policy = None
         if self.model is not None:
             del self.model
             self.model = None
@@ -0,0 +1,85 @@
+import os
+import glob
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import cv2
+
+logging.basicConfig(level=logging.INFO)
+
+
+class CameraDiscovery:
+    """
+    find usable camera indices without blocking for max_index sequential opens
+
+    every index is probed on its own thread and a probe slower than timeout counts as
+    unavailable. results are cached with a fingerprint of the video devices
+    (/dev/video* on Linux) and only re-probed when that fingerprint changes. where
+    devices can't be listed the cache is kept until discover(refresh=True).
+
+    max_index: probe indices 0..max_index-1
+    timeout: seconds for the whole parallel probe
+    """
+
+    def __init__(self,max_index=6,timeout=2.0,api_preference=cv2.CAP_ANY):
+        self.max_index = max_index
+        self.timeout = timeout
+        self.api_preference = api_preference
+        self.cached = None
+        self.fingerprint = None
+        self.probe_time = 0.0
+
+    @staticmethod
+    def device_fingerprint():
+        """
+        return: tuple of (device, device number, change time) or None if unsupported
+        """
+        devices = sorted(glob.glob('/dev/video*'))
+        if not devices and not os.path.isdir('/dev'):
+            return None
+        fingerprint = []
+        for device in devices:
+            try:
+                stat = os.stat(device)
+            except OSError:
+                continue
+            fingerprint.append((device, stat.st_rdev, stat.st_ctime))
+        return tuple(fingerprint)
+
+    def probe(self,idx):
+        cap = cv2.VideoCapture(idx,self.api_preference)
+        try:
+            return cap.isOpened()
+        finally:
+            cap.release()
+
+    def discover(self,refresh=False):
+        """
+        refresh: always re-probe, a camera released by another process doesn't change the fingerprint
+        return: sorted list of available camera indices
+        """
+        fingerprint = self.device_fingerprint()
+        if self.cached is not None and not refresh:
+            if fingerprint is None or fingerprint == self.fingerprint:
+                return list(self.cached)
+
+        st = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.max_index)
+        futures = {executor.submit(self.probe,i):i for i in range(self.max_index)}
+        done, not_done = wait(futures,timeout=self.timeout)
+        # don't wait for hung probes, they finish (and release) in the background
+        executor.shutdown(wait=False)
+
+        available = sorted(futures[f] for f in done if f.exception() is None and f.result())
+        for f in not_done:
+            logging.warning(f"Camera {futures[f]} probe timed out")
+
+        self.cached = available
+        self.fingerprint = fingerprint
+        self.probe_time = time.time() - st
+        logging.info(f"found cameras {available} in {self.probe_time:.2f}s")
+        return list(available)
+
+    def invalidate(self):
+        self.cached = None
@@ -0,0 +1,190 @@
+import os
+import json
+import queue
+import threading
+import logging
+import traceback
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+
+STAGES = ['capture_start','capture_end','perception_end','policy_end','control_end']
+
+
+def is_log_file(name):
+    return name == 'meta.json' or (name.startswith('chunk_') and name.endswith('.bin'))
+
+
+class DriveLogger:
+    """
+    append-only binary log of a whole drive
+
+    layout: log_dir/meta.json describes one fixed-size record (numpy structured dtype),
+            log_dir/chunk_XXXXX.bin are raw records back to back, a new chunk every
+            chunk_size records. a partly written trailing record is ignored on read
+            so a crash only loses the last step.
+
+    per step: camera frames, uint8 seg maps, latent, maneuver, action and the
+              monotonic timestamps of STAGES
+
+    log() only copies the step into a bounded queue, packing and writing happen on a
+    background thread. when the writer falls behind steps are dropped and counted.
+    the record layout is fixed by the first step, a step with other frame / seg shapes
+    is dropped and counted as mismatched.
+
+    log_dir must not hold a previous log, stale chunks would be read as part of this one
+    """
+
+    def __init__(self,log_dir,chunk_size=256,max_queue=32):
+        self.log_dir = log_dir
+        self.chunk_size = chunk_size
+        self.records = queue.Queue(maxsize=max_queue)
+        self.dtype = None
+        self.written = 0
+        self.dropped = 0
+        self.mismatched = 0
+        self.error = None
+        self.file = None
+        if os.path.isdir(log_dir) and any(is_log_file(f) for f in os.listdir(log_dir)):
+            raise FileExistsError(f"{log_dir} already holds a drive log, choose an empty directory")
+        os.makedirs(log_dir, exist_ok=True)
+        self.writer_thread = threading.Thread(target=self._write_loop)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def log(self,frames,segs,latent,maneuver,action,timestamps):
+        """
+        frames: list of RGB images, segs: list of uint8 seg maps,
+        latent: 1d latent vector, maneuver: high level command,
+        action: agent action, timestamps: monotonic time of each of STAGES
+        """
+        if self.error is not None:
+            # writer stopped, nothing is written anymore
+            self.dropped += 1
+            return
+        try:
+            record = {'frames':np.stack(frames),
+                      'segs':np.stack([np.asarray(seg,dtype=np.uint8) for seg in segs]),
+                      'latent':np.array(latent,dtype=np.float32).ravel(),
+                      'maneuver':np.array(maneuver,dtype=np.int32).ravel(),
+                      'action':np.array(action,dtype=np.float32).ravel(),
+                      'timestamps':np.array(timestamps,dtype=np.float64)}
+        except ValueError:
+            # cameras with different frame shapes can't be stacked
+            self._mismatch("cameras of different shapes")
+            return
+        if self.dtype is None:
+            self.dtype = np.dtype([(k,v.dtype,v.shape) for k,v in record.items()])
+        elif any(v.shape != self.dtype[k].shape for k,v in record.items()):
+            self._mismatch({k:v.shape for k,v in record.items()})
+            return
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _mismatch(self,shapes):
+        if self.mismatched == 0:
+            logging.warning(f"drive log step doesn't match the record layout {self.dtype}: {shapes}, "
+                            "mismatched steps are dropped")
+        self.mismatched += 1
+
+    def _write_meta(self):
+        fields = [[k,self.dtype[k].base.str,list(self.dtype[k].shape)] for k in self.dtype.names]
+        meta = {'fields':fields,
+                'stages':STAGES,
+                'chunk_size':self.chunk_size}
+        with open(os.path.join(self.log_dir,'meta.json'),'w') as file:
+            json.dump(meta,file,indent=4)
+
+    def _write_loop(self):
+        try:
+            while True:
+                record = self.records.get()
+                if record is None:
+                    break
+                if self.written == 0:
+                    self._write_meta()
+                if self.written % self.chunk_size == 0:
+                    if self.file is not None:
+                        self.file.close()
+                    chunk_path = os.path.join(self.log_dir,f"chunk_{self.written//self.chunk_size:05d}.bin")
+                    self.file = open(chunk_path,'wb')
+                packed = np.zeros(1,dtype=self.dtype)
+                for k,v in record.items():
+                    packed[k] = v
+                self.file.write(packed.tobytes())
+                self.written += 1
+        except Exception as e:
+            # e.g. disk full, later steps are dropped, close() doesn't wait on the queue
+            self.error = e
+            logging.error(f"drive log writer stopped after {self.written} steps: {e}\n{traceback.format_exc()}")
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def get_stats(self):
+        return {'queue_depth':self.records.qsize(),
+                'written':self.written,
+                'dropped':self.dropped,
+                'mismatched':self.mismatched}
+
+    def close(self):
+        # the writer may have stopped with a full queue, don't wait on it then
+        while self.writer_thread.is_alive():
+            try:
+                self.records.put(None,timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.writer_thread.join()
+        logging.info(f"Drive log saved at {self.log_dir}, {self.written} steps, "
+                     f"dropped {self.dropped}, mismatched {self.mismatched}")
+
+
+class DriveLogReader:
+    """
+    random-access, zero-copy reader of a DriveLogger directory through np.memmap
+
+    reader[i] returns the structured record of step i, reader[i]['frames'] etc.
+    are views into the mapped file.
+    """
+
+    def __init__(self,log_dir):
+        self.log_dir = log_dir
+        with open(os.path.join(log_dir,'meta.json'),'r') as file:
+            meta = json.load(file)
+        self.stages = meta['stages']
+        self.chunk_size = meta['chunk_size']
+        self.dtype = np.dtype([(k,np.dtype(t),tuple(shape)) for k,t,shape in meta['fields']])
+        self.chunks = []
+        chunk_files = sorted(f for f in os.listdir(log_dir) if f.startswith('chunk_') and f.endswith('.bin'))
+        for f in chunk_files:
+            path = os.path.join(log_dir,f)
+            n_records = os.path.getsize(path) // self.dtype.itemsize
+            if n_records > 0:
+                self.chunks.append(np.memmap(path,dtype=self.dtype,mode='r',shape=(n_records,)))
+        # first step of every chunk, chunks aren't assumed to be full
+        self.offsets = np.cumsum([0]+[len(chunk) for chunk in self.chunks])
+        self.length = int(self.offsets[-1])
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self,idx):
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError(f"step {idx} out of range for {self.length} steps")
+        chunk_idx = int(np.searchsorted(self.offsets,idx,side='right'))-1
+        return self.chunks[chunk_idx][idx-self.offsets[chunk_idx]]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for record in chunk:
+                yield record
+
+    @property
+    def fields(self):
+        return self.dtype.names
@@ -1,30 +1,201 @@
 import cv2
 import numpy as np 
 import threading
-import queue
 import logging
+import time
+import multiprocessing as mp
+from collections import deque
 
 import cv2
 import logging
 import numpy as np
 
+from .sources import FrameSource,open_source
+
 logging.basicConfig(level=logging.INFO)
 
+
+def center_crop_box(shape, crop):
+    """
+    same center crop as HFsegWrapper
+    input: frame shape, crop (h,w)
+    return: y1,y2,x1,x2
+    """
+    h,w = crop
+    return max(int(shape[0]/2-h/2),0), min(int(shape[0]/2+h/2),shape[0]), \
+           max(int(shape[1]/2-w/2),0), min(int(shape[1]/2+w/2),shape[1])
+
+
+def frame_health(image, prev_sample=None, stride=8, th=45):
+    """
+    blank/cover statistics of one RGB frame on a strided subsample, same checks as
+    tools.camera_blankorcover without touching full resolution pixels
+    input: image, subsample of the previous frame of this camera
+    return: health dict, subsample (keep it for the next frame)
+    """
+    sample = np.ascontiguousarray(image[::stride, ::stride])
+    blank = bool(np.all(sample == sample[0, 0]))
+    gray = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+    cover_percentage = float(np.count_nonzero(gray <= th)) / gray.size * 100
+    frozen = (not blank) and prev_sample is not None and np.array_equal(sample, prev_sample)
+    health = {'blank':blank,
+              'cover_percentage':cover_percentage,
+              'blank_or_cover':blank or cover_percentage > 50,
+              'frozen':frozen}
+    return health, sample
+
+
+class CamGrabber:
+    """
+    keep draining one cv2.VideoCapture on its own thread and hold only the newest frame
+
+    latest() never blocks on the device, it returns the newest BGR frame with the
+    monotonic time it was captured. frames overwritten before anyone read them are
+    counted in dropped.
+    """
+
+    def __init__(self, cap):
+        self.cap = cap
+        # cameras / sources without a reported rate are taken as 30 fps
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        self.frame_period = 1.0/fps if fps and fps > 0 else 1.0/30
+        self.lock = threading.Lock()
+        self.frame = None
+        self.timestamp = None
+        self.frame_id = 0
+        self.read_id = 0
+        self.dropped = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while self.running:
+            # stamp right after grab, retrieve (decode) time shouldn't count as frame age
+            if not self.cap.grab():
+                time.sleep(0.005)
+                continue
+            timestamp = time.monotonic()
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                continue
+            with self.lock:
+                if self.frame is not None and self.read_id != self.frame_id:
+                    self.dropped += 1
+                self.frame = frame
+                self.timestamp = timestamp
+                self.frame_id += 1
+
+    def wait_newer(self, timestamp, timeout):
+        """
+        wait until a frame newer than timestamp arrives or timeout runs out
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.timestamp is not None and self.timestamp > timestamp:
+                    return True
+            time.sleep(0.001)
+        return False
+
+    def latest(self):
+        """
+        return: newest frame (None if nothing captured yet), capture timestamp
+        """
+        with self.lock:
+            self.read_id = self.frame_id
+            return self.frame, self.timestamp
+
+    def stop(self):
+        self.running = False
+        self.thread.join(timeout=1)
+
+
 class RGBCams:
-    def __init__(self, n_cam, width=1280, height=720):
+    """
+    grabber: opt-in, every camera gets a CamGrabber thread so read_images returns
+             the newest frame right away instead of waiting on cap.read()
+    sync: read_images returns a synchronized snapshot (see read_synced)
+    max_skew: allowed spread in seconds between capture times of one frame set,
+              None only measures the skew
+    sync_retries: how many times to re-grab before flagging the frame set
+    pool_size: opt-in buffer pool, every camera converts into a ring of pool_size
+               preallocated frames and blank cameras share one read-only frame.
+               a returned frame stays valid for pool_size-1 further reads.
+    roi: center crop (h,w) applied right after capture, color conversion and
+         blank frames only cover the roi and read_images returns roi sized frames
+    realtime_sources: offline sources (video, image dir, drive log) are paced to their
+                      fps instead of free-running
+    health_stride: pixel stride of the subsample used for the per frame health stats
+    cover_th: gray level at or below which a pixel counts as covered
+    frozen_limit: consecutive identical frames before a camera is reported frozen. in
+                  grabber mode only a newly captured frame is compared, re-reading a frame
+                  the grabber hasn't replaced yet doesn't count
+    """
+
+    def __init__(self, n_cam, width=1280, height=720, grabber=False,
+                 sync=False, max_skew=None, sync_retries=2, pool_size=None, roi=None,
+                 realtime_sources=False, health_stride=8, cover_th=45, frozen_limit=3):
         self.n_cam = n_cam
         self.width = width
         self.height = height
+        self.grabber = grabber
+        self.sync = sync
+        self.max_skew = max_skew
+        self.sync_retries = sync_retries
+        self.skew = 0.0
+        self.skew_exceeded = False
+        self.roi = roi
+        self.realtime_sources = realtime_sources
+        self.health_stride = health_stride
+        self.cover_th = cover_th
+        self.frozen_limit = frozen_limit
+        self.health = [None]*n_cam
+        self.health_samples = [None]*n_cam
+        self.health_stamps = [None]*n_cam
+        self.frozen_counts = [0]*n_cam
+        self.out_height, self.out_width = height, width
+        if roi is not None:
+            assert len(roi) == 2
+            y1,y2,x1,x2 = center_crop_box((height, width), roi)
+            self.out_height, self.out_width = y2-y1, x2-x1
+        self.pool_size = pool_size
+        self.rings = [None]*n_cam
+        self.ring_pos = [0]*n_cam
+        self.bgr_buffers = [None]*n_cam
+        self.alloc_bytes = 0
+        self.blank = None
+        if pool_size:
+            assert pool_size >= 2, "pool_size must be at least 2"
+            self.blank = np.zeros((self.out_height, self.out_width, 3), dtype=np.uint8)
+            self.blank.flags.writeable = False
         self.caps = [None]*n_cam
+        self.grabbers = [None]*n_cam
         self.initialized_index = [None]*n_cam
+        self.frame_ages = [None]*n_cam
+        self.dropped_frames = [0]*n_cam
 
     def initialize_cameras(self, cam_idx,pos):
-        if isinstance(cam_idx,int):
+        """
+        cam_idx: device index, a FrameSource or the path of a video file,
+                 image directory or drive log to replay
+        """
+        if isinstance(cam_idx,(int,str,FrameSource)):
             if cam_idx in self.initialized_index:
                 prev_pos = self.initialized_index.index(cam_idx)
                 self.release_cameras(prev_pos)
 
-            cap = cv2.VideoCapture(cam_idx, cv2.CAP_DSHOW)
+            if isinstance(cam_idx,int):
+                cap = cv2.VideoCapture(cam_idx, cv2.CAP_DSHOW)
+            elif isinstance(cam_idx,str):
+                try:
+                    cap = open_source(cam_idx,realtime=self.realtime_sources)
+                except FileNotFoundError as e:
+                    logging.warning(f"Camera {cam_idx} failed to initialize: {e}")
+                    return
+            else:
+                cap = cam_idx
             if not cap.isOpened():
                 logging.warning(f"Camera {cam_idx} failed to initialize")
                 cap.release()
@@ -36,40 +207,221 @@ class RGBCams:
                     self.release_cameras(pos)
                 self.caps[pos] = cap
                 self.initialized_index[pos] = cam_idx
+                if self.grabber:
+                    self.grabbers[pos] = CamGrabber(cap)
 
 
     
     def release_cameras(self, pos):
         if self.initialized_index[pos] is not None:
+            # the grabber thread must stop reading before the device is released
+            if self.grabbers[pos] is not None:
+                self.grabbers[pos].stop()
+                self.grabbers[pos] = None
             self.caps[pos].release()
             self.caps[pos] = None
             self.initialized_index[pos] = None
             logging.info(f"removed cam position {pos}")
             
 
+    def _blank(self):
+        if self.blank is not None:
+            return self.blank
+        self.alloc_bytes += self.out_height*self.out_width*3
+        return np.zeros((self.out_height, self.out_width, 3), dtype=np.uint8)
+
+    def _bgr_buffer(self, i):
+        """
+        destination for cap.read/retrieve, the device decodes into it in place
+        """
+        if not self.pool_size:
+            return None
+        if self.bgr_buffers[i] is None:
+            self.bgr_buffers[i] = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        return self.bgr_buffers[i]
+
+    def _to_rgb(self, i, frame):
+        if self.pool_size and frame is not self.bgr_buffers[i]:
+            # driver handed over its own array (grabber thread or shape mismatch)
+            self.alloc_bytes += frame.nbytes
+        if self.roi is not None:
+            # zero-copy view, everything after this only touches roi pixels
+            y1,y2,x1,x2 = center_crop_box(frame.shape, self.roi)
+            frame = frame[y1:y2,x1:x2]
+        if not self.pool_size:
+            self.alloc_bytes += frame.nbytes
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+        ring = self.rings[i]
+        if ring is None or ring[0].shape != frame.shape:
+            ring = [np.empty(frame.shape, dtype=np.uint8) for _ in range(self.pool_size)]
+            self.rings[i] = ring
+            self.alloc_bytes += frame.nbytes*self.pool_size
+        dst = ring[self.ring_pos[i]]
+        self.ring_pos[i] = (self.ring_pos[i]+1) % self.pool_size
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=dst)
+        return dst
+
     def read_images(self):
+        self.alloc_bytes = 0
+        if self.sync:
+            return self.read_synced()
+        if self.grabber:
+            return self._read_latest()
         imgs = []
         for i,cap in enumerate(self.caps):
             if cap is not None:
-                ret, frame = cap.read()
+                ret, frame = cap.read(self._bgr_buffer(i))
                 if ret:
-                    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    imgs.append(rgb_frame)
+                    imgs.append(self._to_rgb(i,frame))
                 else:
                     logging.warning("Failed to read frame")
-                    imgs.append(np.zeros((self.height, self.width, 3), dtype=np.uint8))  # Placeholder for failed capture
+                    imgs.append(self._blank())  # Placeholder for failed capture
                     
             else:
                 # print(f"cam index {i} are blanking")
-                imgs.append(np.zeros((self.height, self.width, 3), dtype=np.uint8))  # Placeholder for failed capture
+                imgs.append(self._blank())  # Placeholder for failed capture
+        self.rgb_image = imgs
+        self._update_health(imgs)
+        return self.rgb_image
+
+    def _read_latest(self):
+        imgs = []
+        timestamps = [None]*self.n_cam
+        now = time.monotonic()
+        for i,grabber in enumerate(self.grabbers):
+            frame = None
+            if grabber is not None:
+                frame, timestamps[i] = grabber.latest()
+                self.dropped_frames[i] = grabber.dropped
+            if frame is not None:
+                self.frame_ages[i] = now - timestamps[i]
+                imgs.append(self._to_rgb(i,frame))
+            else:
+                self.frame_ages[i] = None
+                imgs.append(self._blank())  # Placeholder for failed capture
+        self.rgb_image = imgs
+        self._update_health(imgs, timestamps)
+        return self.rgb_image
+
+    def _update_health(self, imgs, timestamps=None):
+        """
+        health of every returned frame, health[i] belongs to imgs[i]
+        timestamps: grabber capture times, a frame read again keeps its health and
+                    frozen count (the grabber hasn't delivered a new one yet)
+        """
+        for i,img in enumerate(imgs):
+            if timestamps is not None:
+                if timestamps[i] is not None and timestamps[i] == self.health_stamps[i]:
+                    continue
+                self.health_stamps[i] = timestamps[i]
+            health, self.health_samples[i] = frame_health(img, self.health_samples[i],
+                                                          stride=self.health_stride, th=self.cover_th)
+            self.frozen_counts[i] = self.frozen_counts[i]+1 if health['frozen'] else 0
+            health['frozen'] = self.frozen_counts[i] >= self.frozen_limit
+            self.health[i] = health
+
+    def read_synced(self):
+        """
+        grab all cameras together then retrieve, so one frame set comes from
+        (nearly) one instant. skew is the spread of capture times, when it is above
+        max_skew the set is re-grabbed up to sync_retries times and flagged with
+        skew_exceeded if it is still too wide.
+
+        in grabber mode the threads already grab continuously, the snapshot waits
+        for the stalest camera to deliver a newer frame instead of re-grabbing.
+        """
+        self.alloc_bytes = 0
+        if self.grabber:
+            frames, timestamps = self._sync_latest()
+        else:
+            frames, timestamps = self._sync_grab()
+
+        stamped = [t for t in timestamps if t is not None]
+        self.skew = max(stamped) - min(stamped) if stamped else 0.0
+        self.skew_exceeded = self.max_skew is not None and self.skew > self.max_skew
+        if self.skew_exceeded:
+            logging.warning(f"camera skew {self.skew*1000:.1f} ms exceeds {self.max_skew*1000:.1f} ms")
+
+        now = time.monotonic()
+        imgs = []
+        for i,frame in enumerate(frames):
+            if frame is not None:
+                self.frame_ages[i] = now - timestamps[i]
+                imgs.append(self._to_rgb(i,frame))
+            else:
+                self.frame_ages[i] = None
+                imgs.append(self._blank())  # Placeholder for failed capture
         self.rgb_image = imgs
+        self._update_health(imgs, timestamps if self.grabber else None)
         return self.rgb_image
 
+    def _within_skew(self, timestamps):
+        stamped = [t for t in timestamps if t is not None]
+        if self.max_skew is None or len(stamped) < 2:
+            return True
+        return max(stamped) - min(stamped) <= self.max_skew
+
+    def _sync_grab(self):
+        for _ in range(self.sync_retries+1):
+            timestamps = [None]*self.n_cam
+            for i,cap in enumerate(self.caps):
+                if cap is not None and cap.grab():
+                    timestamps[i] = time.monotonic()
+            if self._within_skew(timestamps):
+                break
+
+        frames = [None]*self.n_cam
+        for i,cap in enumerate(self.caps):
+            if timestamps[i] is not None:
+                ret, frame = cap.retrieve(self._bgr_buffer(i))
+                if ret:
+                    frames[i] = frame
+                else:
+                    logging.warning("Failed to read frame")
+                    timestamps[i] = None
+        return frames, timestamps
+
+    def _sync_latest(self):
+        frames = [None]*self.n_cam
+        timestamps = [None]*self.n_cam
+        for _ in range(self.sync_retries+1):
+            for i,grabber in enumerate(self.grabbers):
+                if grabber is not None:
+                    frames[i], timestamps[i] = grabber.latest()
+                    self.dropped_frames[i] = grabber.dropped
+            if self._within_skew(timestamps):
+                break
+            # give the stalest camera one frame period to catch up
+            stalest = min((t,i) for i,t in enumerate(timestamps) if t is not None)[1]
+            grabber = self.grabbers[stalest]
+            grabber.wait_newer(timestamps[stalest], timeout=grabber.frame_period)
+        return frames, timestamps
+
+    def get_stats(self):
+        """
+        return: per camera age of the returned frame in seconds (None if blank),
+                count of frames the grabber overwrote before they were read
+                the skew of the last synchronized frame set and bytes of frame
+                memory allocated by the last read
+        """
+        return {'frame_ages':list(self.frame_ages),
+                'dropped_frames':list(self.dropped_frames),
+                'skew':self.skew,
+                'skew_exceeded':self.skew_exceeded,
+                'alloc_bytes':self.alloc_bytes}
+
     def close(self):
+        for grabber in self.grabbers:
+            if grabber is not None:
+                grabber.stop()
         for cap in self.caps:
             if cap is not None:
                 cap.release()
         self.caps = [None]*self.n_cam
+        self.grabbers = [None]*self.n_cam
+        self.rings = [None]*self.n_cam
+        self.bgr_buffers = [None]*self.n_cam
         self.initialized_index = [None]*self.n_cam
         logging.info("All cameras released and lists cleared")
 
@@ -83,65 +435,140 @@ class RGBCams:
 
 
 
+def compose_grid(frame_set):
+    """
+    tile RGB frames of one step into a single BGR frame for cv2.VideoWriter
+    """
+    height, width, _ = frame_set[0].shape
+    n_cams = len(frame_set)
+    grid_size = int(np.ceil(np.sqrt(n_cams)))
+    frame_height = height // grid_size
+    frame_width = width // grid_size
+    output_height = frame_height * grid_size
+    output_width = frame_width * grid_size
+
+    combined_frame = np.zeros((output_height, output_width, 3), dtype=np.uint8)
+    for i, frame in enumerate(frame_set):
+        resized_frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), (frame_width, frame_height))
+        row = i // grid_size
+        col = i % grid_size
+        combined_frame[row*frame_height:(row+1)*frame_height, col*frame_width:(col+1)*frame_width] = resized_frame
+    return combined_frame
+
+
+def encode_video(video_path, fourcc, fps, frame_queue):
+    """
+    encoder process loop, runs until it receives None
+    """
+    out = None
+    while True:
+        frame_set = frame_queue.get()
+        if frame_set is None:
+            break
+        combined_frame = compose_grid(frame_set)
+        if out is None:
+            output_height, output_width, _ = combined_frame.shape
+            out = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*fourcc), fps, (output_width, output_height))
+        out.write(combined_frame)
+    if out is not None:
+        out.release()
+
+
 class Recorder:
+    """
+    record the camera frame sets of AVbot.step to video without slowing the control loop
 
-    def __init__(self,video_path):
-        self.recorded = queue.Queue()
+    add_images only puts references to the frames into a bounded queue, when the queue is
+    full the oldest frame set is dropped. a feeder thread copies the sets (pooled frames only)
+    and hands them to a separate encoder process that does the grid compositing and
+    cv2.VideoWriter encoding.
+
+    video_path: output file
+    fps: frame rate written to the video
+    max_queue: frame sets waiting in the control process before dropping
+    valid_reads: further reads a frame stays valid for (RGBCams pool_size-1), None when every
+                 read returns new frames. the queue is capped to it so the oldest waiting set
+                 is still valid when the feeder copies it
+    """
+
+    def __init__(self,video_path,fps=20.0,max_queue=8,fourcc='XVID',valid_reads=None):
         self.video_path = video_path
-        self.fourcc = cv2.VideoWriter_fourcc(*'XVID')
-        self.out = None
+        self.fps = fps
+        self.fourcc = fourcc
+        self.valid_reads = valid_reads
+        self.pending = deque(maxlen=min(max_queue,valid_reads) if valid_reads else max_queue)
+        self.cond = threading.Condition()
         self.is_recording = False
-        self.saving_thread = threading.Thread(target=self.save_video_real_time)
-        self.saving_thread.daemon = True
-        self.saving_thread.start()
-        self.rgb_image = []
+        self.dropped = 0
+        self.recorded = 0
+        self.frame_queue = None
+        self.process = None
+        self.feeder_thread = None
 
+    def start_recording(self):
+        if self.is_recording:
+            return
+        self.dropped = 0
+        self.recorded = 0
+        # small pipe, backpressure stays in the feeder thread and the pending deque
+        self.frame_queue = mp.Queue(maxsize=2)
+        self.process = mp.Process(target=encode_video,
+                                  args=(self.video_path,self.fourcc,self.fps,self.frame_queue))
+        self.process.daemon = True
+        self.process.start()
+        self.is_recording = True
+        self.feeder_thread = threading.Thread(target=self._feed)
+        self.feeder_thread.daemon = True
+        self.feeder_thread.start()
+        logging.info(f"Recording to {self.video_path}")
 
-    def add_images(self):
-        if self.rgb_image:
-            self.recorded.put(self.rgb_image)
-        else:
-            print("Warning: No images to add")
+    def add_images(self,images):
+        if not self.is_recording:
+            return
+        if not images:
+            logging.warning("No images to add")
+            return
+        with self.cond:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(list(images))
+            self.cond.notify()
 
-    def start_recording(self, fps=20.0):
-        self.is_recording = True
-        first_image_set = self.recorded.get()
-        height, width, _ = first_image_set[0].shape
-        self.recorded.task_done()
-        n_cams = len(self.caps)
-        grid_size = int(np.ceil(np.sqrt(n_cams)))
-        frame_height = height // grid_size
-        frame_width = width // grid_size
-        output_height = frame_height * grid_size
-        output_width = frame_width * grid_size
-
-        self.out = cv2.VideoWriter(self.video_path, self.fourcc, fps, (output_width, output_height))
+    def _feed(self):
+        while True:
+            with self.cond:
+                while not self.pending and self.is_recording:
+                    self.cond.wait()
+                if not self.pending:
+                    break
+                frame_set = self.pending.popleft()
+            if self.valid_reads:
+                # pooled frames, copy before RGBCams reuses the buffers
+                frame_set = [np.array(img) for img in frame_set]
+            self.frame_queue.put(frame_set)
+            self.recorded += 1
+        self.frame_queue.put(None)
 
     def stop_recording(self):
-        self.is_recording = False
-        self.saving_thread.join()
-        if self.out:
-            self.out.release()
-        print(f"Video saved at {self.video_path}")
-
-    def save_video_real_time(self):
-        while self.is_recording or not self.recorded.empty():
-            if not self.recorded.empty():
-                frame_set = self.recorded.get()
-                height, width, _ = frame_set[0].shape
-                n_cams = len(frame_set)
-                grid_size = int(np.ceil(np.sqrt(n_cams)))
-                frame_height = height // grid_size
-                frame_width = width // grid_size
-                output_height = frame_height * grid_size
-                output_width = frame_width * grid_size
-
-                combined_frame = np.zeros((output_height, output_width, 3), dtype=np.uint8)
-                for i, frame in enumerate(frame_set):
-                    resized_frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR), (frame_width, frame_height))
-                    row = i // grid_size
-                    col = i % grid_size
-                    combined_frame[row*frame_height:(row+1)*frame_height, col*frame_width:(col+1)*frame_width] = resized_frame
-
-                self.out.write(combined_frame)
-                self.recorded.task_done()
+        if not self.is_recording:
+            return
+        with self.cond:
+            self.is_recording = False
+            self.cond.notify()
+        # frame sets still pending are flushed before the encoder stops
+        self.feeder_thread.join()
+        self.process.join()
+        self.frame_queue.close()
+        self.feeder_thread = None
+        self.process = None
+        self.frame_queue = None
+        logging.info(f"Video saved at {self.video_path}, dropped {self.dropped} frame sets")
+
+    def get_stats(self):
+        """
+        return: frame sets waiting in queue, dropped and sent to the encoder
+        """
+        with self.cond:
+            return {'queue_depth':len(self.pending),
+                    'dropped':self.dropped,
+                    'recorded':self.recorded}
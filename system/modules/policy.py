@@ -0,0 +1,348 @@
+"""
+deterministic policy runtimes for Agent
+
+python -m system.modules.policy RLmodel/SAC_51/model.zip [npz|onnx]
+
+exports the actor of the SB3 zip and the action-space bounds to model.policy.npz (pure NumPy)
+or model.policy.onnx (ONNX Runtime) next to the zip, with the sha256 of the zip. Agent prefers
+the artifact of the selected zip while that hash matches and then never imports
+stable_baselines3 / sb3_contrib or unpacks the zip.
+"""
+import os
+import sys
+import json
+import logging
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+logging.basicConfig(level=logging.INFO)
+
+# <zip stem>.policy.<ext> next to the zip, looked up in this order
+POLICY_ARTIFACTS = ('onnx','npz')
+
+
+def load_sb3(model_path,algo_name,device):
+    """
+    load a stable_baselines3 / sb3_contrib model, the packages are only imported here
+    """
+    import stable_baselines3
+    try:
+        algo = getattr(stable_baselines3, algo_name)
+    except AttributeError:
+        import sb3_contrib
+        try:
+            algo = getattr(sb3_contrib, algo_name)
+        except AttributeError:
+            raise ValueError(f"{algo_name} is not found in both stable_baselines3 and sb3_contrib")
+    return algo.load(model_path, device=device)
+
+
+def artifact_path(model_path,fmt):
+    return f"{os.path.splitext(model_path)[0]}.policy.{fmt}"
+
+
+def load_exported_policy(model_path,source_path=None):
+    """
+    runtime of the artifact exported from model_path, artifacts of an other (retrained) zip
+    are skipped with a warning
+    source_path: file actually loaded for model_path (model store blob), default model_path
+    return: NumpyPolicy / OnnxPolicy or None
+    """
+    from wrapper.model_store import file_digest
+    digest = None
+    for fmt in POLICY_ARTIFACTS:
+        path = artifact_path(model_path,fmt)
+        if not os.path.exists(path):
+            continue
+        digest = digest or file_digest(source_path or model_path)
+        runtime = load_artifact(path)
+        if runtime.meta.get('source_sha256') == digest:
+            return runtime
+        logging.warning(f"{path} wasn't exported from {model_path} (retrained?), ignored. "
+                        f"re-export with python -m system.modules.policy {model_path} {fmt}")
+    return None
+
+
+def deterministic_actor(policy):
+    """
+    the deterministic action path of a SB3 / sb3_contrib policy as one nn.Sequential
+    SAC / TQC: features -> latent_pi -> mu -> tanh (mode of the squashed gaussian, also with gSDE)
+    PPO (continuous actions): features -> mlp_extractor.policy_net -> action_net (-> tanh with squash_output)
+    return: actor, squash_output of the policy (actions are unscaled instead of clipped)
+    """
+    if not hasattr(policy.action_space,'low'):
+        raise NotImplementedError(f"policy engine needs a Box action space, got {policy.action_space}")
+    if hasattr(policy,'actor') and hasattr(policy.actor,'mu'):
+        actor = policy.actor
+        layers = [actor.features_extractor,actor.latent_pi,actor.mu,nn.Tanh()]
+    elif hasattr(policy,'mlp_extractor') and hasattr(policy,'action_net'):
+        features_extractor = getattr(policy,'pi_features_extractor',policy.features_extractor)
+        layers = [features_extractor,policy.mlp_extractor.policy_net,policy.action_net]
+        if policy.squash_output:
+            layers.append(nn.Tanh())
+    else:
+        raise NotImplementedError(f"no deterministic actor for {type(policy).__name__}")
+    if not isinstance(layers[0],nn.Flatten) and type(layers[0]).__name__ != 'FlattenExtractor':
+        raise NotImplementedError(f"policy engine needs a flatten features extractor, got {type(layers[0]).__name__}")
+    return nn.Sequential(*layers).eval(), policy.squash_output
+
+
+class PolicyRuntime:
+    """
+    action post-processing of BasePolicy.predict shared by the runtimes: reshape to the action
+    space, unscale (squash_output) or clip to the bounds, squeeze the batch of a single observation
+    """
+
+    def __init__(self,observation_shape,action_shape,low,high,squash_output):
+        self.observation_shape = tuple(observation_shape)
+        self.action_shape = tuple(action_shape)
+        self.low = np.asarray(low,dtype=np.float32)
+        self.high = np.asarray(high,dtype=np.float32)
+        self.squash_output = squash_output
+
+    def _vectorized(self,observation):
+        # same check as stable_baselines3 is_vectorized_box_observation
+        if observation.shape == self.observation_shape:
+            return False
+        if observation.shape[1:] == self.observation_shape:
+            return True
+        raise ValueError(f"observation shape {observation.shape} doesn't match {self.observation_shape}")
+
+    def _actions(self,observation):
+        """
+        input: observation (batch,)+observation_shape
+        return: raw actor output as numpy
+        """
+        raise NotImplementedError
+
+    def predict(self,observation):
+        """
+        input: observation as given to model.predict
+        return: actions, None (same as model.predict(observation,deterministic=True))
+        """
+        observation = np.asarray(observation)
+        vectorized = self._vectorized(observation)
+        actions = self._actions(observation.reshape((-1,)+self.observation_shape))
+        actions = actions.reshape((-1,)+self.action_shape)
+        if self.squash_output:
+            actions = self.low + (0.5 * (actions + 1.0) * (self.high - self.low))
+        else:
+            actions = np.clip(actions,self.low,self.high)
+        if not vectorized:
+            actions = actions.squeeze(axis=0)
+        return actions, None
+
+    def verify(self,model,observations=None,n=32,atol=1e-6,rtol=0.0):
+        """
+        action parity with model.predict(deterministic=True)
+        observations: observations to compare on, default n samples of the observation space
+        atol, rtol: allowed |actions - predict| <= atol + rtol*|predict|, like np.allclose
+        return: max abs action difference, raises AssertionError above the tolerance
+        """
+        if observations is None:
+            observations = [model.observation_space.sample() for _ in range(n)]
+        diff = 0.0
+        excess = 0.0
+        for observation in observations:
+            expected,_ = model.predict(observation,deterministic=True)
+            actions,_ = self.predict(observation)
+            assert actions.shape == expected.shape and actions.dtype == expected.dtype, \
+                f"{type(self).__name__} actions {actions.shape} {actions.dtype}, predict {expected.shape} {expected.dtype}"
+            error = np.abs(actions-expected)
+            diff = max(diff,float(error.max()))
+            excess = max(excess,float((error-(atol+rtol*np.abs(expected))).max()))
+        assert excess <= 0, f"{type(self).__name__} differs from predict by {diff} (atol {atol}, rtol {rtol})"
+        logging.info(f"{type(self).__name__} matches predict on {len(observations)} observations, max diff {diff}")
+        return diff
+
+
+class PolicyEngine(PolicyRuntime):
+    """
+    model.predict(obs,deterministic=True) without the per step SB3 python overhead
+
+    the actor is pulled out of the loaded model once and run under torch.inference_mode on a
+    preallocated observation tensor
+
+    model: loaded SAC / TQC / PPO
+    """
+
+    def __init__(self,model):
+        policy = model.policy
+        self.actor, squash_output = deterministic_actor(policy)
+        super().__init__(policy.observation_space.shape,policy.action_space.shape,
+                         policy.action_space.low,policy.action_space.high,squash_output)
+        self.device = policy.device
+        self.obs_tensor = torch.zeros((1,)+self.observation_shape,dtype=torch.float32,device=self.device)
+
+    def _actions(self,observation):
+        with torch.inference_mode():
+            if observation.shape == self.obs_tensor.shape:
+                obs = self.obs_tensor
+                obs.copy_(torch.from_numpy(observation))
+            else:
+                obs = torch.as_tensor(observation,device=self.device).float()
+            return self.actor(obs).cpu().numpy()
+
+
+def _actor_ops(actor):
+    """
+    flatten an actor into (op, params) for the NumPy runtime
+    return: ops [{'op':name,...}], arrays {name: array}
+    """
+    ops, arrays = [], {}
+
+    def add(module):
+        if isinstance(module,nn.Sequential):
+            for child in module:
+                add(child)
+        elif isinstance(module,nn.Flatten) or type(module).__name__ == 'FlattenExtractor':
+            ops.append({'op':'flatten'})
+        elif isinstance(module,nn.Linear):
+            idx = len(arrays)//2
+            arrays[f'weight{idx}'] = module.weight.detach().cpu().numpy().T.copy()
+            arrays[f'bias{idx}'] = module.bias.detach().cpu().numpy()
+            ops.append({'op':'linear','weight':f'weight{idx}','bias':f'bias{idx}'})
+        elif isinstance(module,nn.ReLU):
+            ops.append({'op':'relu'})
+        elif isinstance(module,nn.Tanh):
+            ops.append({'op':'tanh'})
+        elif isinstance(module,nn.LeakyReLU):
+            ops.append({'op':'leaky_relu','slope':module.negative_slope})
+        elif isinstance(module,nn.Hardtanh):
+            ops.append({'op':'hardtanh','min':module.min_val,'max':module.max_val})
+        else:
+            raise NotImplementedError(f"NumPy policy runtime has no {type(module).__name__}")
+
+    add(actor)
+    return ops, arrays
+
+
+class NumpyPolicy(PolicyRuntime):
+    """
+    policy.npz runtime, the actor MLP in float32 NumPy
+    """
+
+    def __init__(self,path):
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            self.arrays = {k:data[k] for k in data.files if k != 'meta'}
+        self.meta = meta
+        self.ops = meta['ops']
+        super().__init__(meta['observation_shape'],meta['action_shape'],
+                         meta['low'],meta['high'],meta['squash_output'])
+
+    def _actions(self,observation):
+        x = observation.astype(np.float32,copy=False)
+        for op in self.ops:
+            if op['op'] == 'flatten':
+                x = x.reshape((x.shape[0],-1))
+            elif op['op'] == 'linear':
+                x = x @ self.arrays[op['weight']] + self.arrays[op['bias']]
+            elif op['op'] == 'relu':
+                x = np.maximum(x,0)
+            elif op['op'] == 'tanh':
+                x = np.tanh(x)
+            elif op['op'] == 'leaky_relu':
+                x = np.where(x > 0,x,x*np.float32(op['slope']))
+            elif op['op'] == 'hardtanh':
+                x = np.clip(x,op['min'],op['max'])
+        return x
+
+
+class OnnxPolicy(PolicyRuntime):
+    """
+    policy.onnx runtime, action-space bounds are in the model metadata
+    """
+
+    def __init__(self,path,intra_op_threads=1):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(path,options,providers=['CPUExecutionProvider'])
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map['policy'])
+        self.meta = meta
+        super().__init__(meta['observation_shape'],meta['action_shape'],
+                         meta['low'],meta['high'],meta['squash_output'])
+
+    def _actions(self,observation):
+        return self.session.run(None,{'observation':observation.astype(np.float32,copy=False)})[0]
+
+
+def load_artifact(path):
+    """
+    return: NumpyPolicy or OnnxPolicy of an exported artifact
+    """
+    if path.endswith('.onnx'):
+        return OnnxPolicy(path)
+    return NumpyPolicy(path)
+
+
+def export_policy(model_path,fmt='npz',export_path=None,opset=17,atol=1e-4,rtol=1e-4):
+    """
+    export the deterministic actor and action-space bounds of an agent zip, checked against
+    model.predict before it's written
+
+    model_path: RLmodel/*/model.zip, the algorithm is read from config.json next to it
+    fmt: 'npz' (NumPy runtime) or 'onnx' (ONNX Runtime)
+    atol, rtol: tolerance of the check, float32 NumPy / onnx runtime kernels accumulate in a
+                different order than torch (~1e-5 on large weights)
+    return: export_path, default <zip stem>.policy.<fmt> next to the zip
+    """
+    from wrapper.model_store import file_digest
+    model_dir = os.path.dirname(model_path)
+    with open(os.path.join(model_dir,"config.json"),'rb') as file:
+        algo_name = json.load(file)['algorithm']['method']
+    model = load_sb3(model_path,algo_name,torch.device("cpu"))
+    engine = PolicyEngine(model)
+    meta = {'algorithm':algo_name,
+            'observation_shape':list(engine.observation_shape),
+            'action_shape':list(engine.action_shape),
+            'low':engine.low.tolist(),
+            'high':engine.high.tolist(),
+            'squash_output':bool(engine.squash_output),
+            'source':os.path.basename(model_path),
+            'source_sha256':file_digest(model_path)}
+    export_path = export_path or artifact_path(model_path,fmt)
+    tmp_path = export_path+'.tmp'+os.path.splitext(export_path)[1]
+
+    if fmt == 'npz':
+        ops, arrays = _actor_ops(engine.actor)
+        meta['ops'] = ops
+        np.savez(tmp_path,meta=np.array(json.dumps(meta)),**arrays)
+        runtime = NumpyPolicy(tmp_path)
+    elif fmt == 'onnx':
+        import onnx
+        example = torch.zeros((1,)+engine.observation_shape)
+        with torch.no_grad():
+            torch.onnx.export(engine.actor,(example,),tmp_path,
+                              input_names=['observation'],output_names=['actions'],
+                              dynamic_axes={'observation':{0:'batch'},'actions':{0:'batch'}},
+                              opset_version=opset,dynamo=False)
+        onnx_model = onnx.load(tmp_path)
+        onnx.helper.set_model_props(onnx_model,{'policy':json.dumps(meta)})
+        onnx.save(onnx_model,tmp_path)
+        runtime = OnnxPolicy(tmp_path)
+    else:
+        raise ValueError(f"unknown policy artifact format {fmt}, use 'npz' or 'onnx'")
+
+    try:
+        runtime.verify(model,atol=atol,rtol=rtol)
+    except AssertionError:
+        os.remove(tmp_path)
+        raise
+    os.replace(tmp_path,export_path)
+    print(f"exported {algo_name} policy to {export_path}")
+    return export_path
+
+
+def main():
+    if len(sys.argv) not in (2,3) or (len(sys.argv) == 3 and sys.argv[2] not in ('npz','onnx')):
+        print(__doc__)
+        sys.exit(1)
+    export_policy(sys.argv[1],*sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
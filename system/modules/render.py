@@ -0,0 +1,112 @@
+import threading
+import logging
+import time
+import traceback
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+
+
+class VisionRenderer:
+    """
+    renders the agent vision (colorized seg maps, VAE decoder output) of AVbot.step on its own
+    thread so the control step never waits for it
+
+    submit only keeps the latest step, a step arriving while one is rendered replaces the
+    waiting one (counted as skipped). frames are copied by the worker when it picks a step
+    up, the control thread only hands over references: the latest read is still valid then
+    (RGBCams pool_size keeps a frame for pool_size-1 further reads). the worker renders at most rate times per second, when
+    the panel is hidden only the camera frames are passed on, nothing is rendered.
+
+    agent: Agent, renders with agent.render(state)
+    rate: max renders per second, None renders every step
+    callback: called on the worker thread with [camera frames]+agent vision after each render,
+              for display only (camera health is checked per control step, not here)
+    """
+
+    def __init__(self,agent,rate=None,callback=None):
+        self.agent = agent
+        self.rate = rate
+        self.callback = callback
+        self.cond = threading.Condition()
+        self.pending = None
+        self.latest = []
+        self.visible = True
+        self.running = True
+        self.rendered = 0
+        self.skipped = 0
+        self.render_time = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def set_rate(self,rate):
+        self.rate = rate
+
+    def set_visible(self,visible):
+        with self.cond:
+            self.visible = visible
+
+    def submit(self,images,agent_vision=True):
+        """
+        latest step for display, called from the control loop right after the step
+        agent_vision: False passes the camera frames only (the agent didn't run this step)
+        """
+        state = self.agent.observer.render_state() if agent_vision else None
+        with self.cond:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = (list(images),state)
+            self.cond.notify()
+
+    def get(self):
+        """
+        return: last rendered [camera frames]+agent vision, doesn't wait for the worker
+        """
+        with self.cond:
+            return self.latest
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                frames, state = self.pending
+                self.pending = None
+                visible = self.visible
+            st = time.time()
+            # copy, RGBCams may reuse its buffers on later reads
+            frames = [np.array(img) for img in frames]
+            vision = [frames]
+            if visible and state is not None:
+                try:
+                    vision += self.agent.render(state)
+                    self.render_time = time.time()-st
+                    self.rendered += 1
+                except Exception as e:
+                    logging.warning(f"agent vision render failed: {e}\n{traceback.format_exc()}")
+            with self.cond:
+                self.latest = vision
+            if self.callback is not None:
+                self.callback(vision)
+            if self.rate:
+                # steps submitted meanwhile are replaced, only the latest is rendered next
+                time.sleep(max(st+1/self.rate-time.time(),0))
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def get_stats(self):
+        """
+        return: steps rendered, steps replaced before being rendered, last render seconds
+        """
+        with self.cond:
+            return {'rendered':self.rendered,
+                    'skipped':self.skipped,
+                    'render_time':self.render_time}
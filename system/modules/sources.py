@@ -0,0 +1,181 @@
+import os
+import time
+import logging
+
+import cv2
+import numpy as np
+
+from .drivelog import DriveLogReader
+
+logging.basicConfig(level=logging.INFO)
+
+IMAGE_EXTS = ('.png','.jpg','.jpeg','.bmp')
+
+
+class FrameSource:
+    """
+    offline stand-in for cv2.VideoCapture that RGBCams can read from
+
+    same calls RGBCams makes on a capture: isOpened, read, grab, retrieve, set, release.
+    frames come out as BGR like a camera, resized when RGBCams sets a frame size.
+
+    realtime: False free-runs as fast as the consumer reads,
+              True paces grab() to fps like a live camera
+    loop: start over at the end instead of failing the read
+    """
+
+    def __init__(self,fps=20.0,realtime=False,loop=True):
+        self.fps = fps
+        self.realtime = realtime
+        self.loop = loop
+        self.next_time = None
+        self.frame = None
+        self.width = None
+        self.height = None
+
+    def _next_frame(self):
+        """
+        return: next BGR frame or None at the end
+        """
+        raise NotImplementedError("Method '_next_frame' must be implemented in subclasses")
+
+    def _rewind(self):
+        raise NotImplementedError("Method '_rewind' must be implemented in subclasses")
+
+    def isOpened(self):
+        return True
+
+    def grab(self):
+        if self.realtime:
+            now = time.monotonic()
+            if self.next_time is None:
+                self.next_time = now
+            elif now < self.next_time:
+                time.sleep(self.next_time - now)
+            self.next_time = max(self.next_time, now) + 1/self.fps
+
+        frame = self._next_frame()
+        if frame is None and self.loop:
+            self._rewind()
+            frame = self._next_frame()
+        if frame is not None and self.width and self.height and frame.shape[:2] != (self.height,self.width):
+            frame = cv2.resize(frame,(self.width,self.height))
+        self.frame = frame
+        return self.frame is not None
+
+    def retrieve(self,image=None):
+        if self.frame is None:
+            return False, None
+        if image is not None and image.shape == self.frame.shape:
+            image[...] = self.frame
+            return True, image
+        return True, self.frame
+
+    def read(self,image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def set(self,prop,value):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.width = int(value)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.height = int(value)
+        else:
+            return False
+        return True
+
+    def get(self,prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width or 0
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height or 0
+        return 0
+
+    def release(self):
+        self.frame = None
+
+
+class VideoFileSource(FrameSource):
+
+    def __init__(self,path,realtime=False,loop=True):
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise FileNotFoundError(f"Can't open video {path}")
+        super().__init__(fps=self.cap.get(cv2.CAP_PROP_FPS) or 20.0,realtime=realtime,loop=loop)
+
+    def _next_frame(self):
+        ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def _rewind(self):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def release(self):
+        super().release()
+        self.cap.release()
+
+
+class ImageDirSource(FrameSource):
+
+    def __init__(self,image_dir,fps=20.0,realtime=False,loop=True):
+        super().__init__(fps=fps,realtime=realtime,loop=loop)
+        self.paths = [os.path.join(image_dir,f) for f in sorted(os.listdir(image_dir))
+                      if f.lower().endswith(IMAGE_EXTS)]
+        if not self.paths:
+            raise FileNotFoundError(f"No images in {image_dir}")
+        self.pos = 0
+
+    def _next_frame(self):
+        if self.pos >= len(self.paths):
+            return None
+        frame = cv2.imread(self.paths[self.pos])
+        self.pos += 1
+        return frame
+
+    def _rewind(self):
+        self.pos = 0
+
+
+class DriveLogSource(FrameSource):
+    """
+    replay one camera of a DriveLogger recording, fps defaults to the logged step rate
+    """
+
+    def __init__(self,log_dir,cam=0,fps=None,realtime=False,loop=True):
+        self.reader = DriveLogReader(log_dir)
+        if len(self.reader) == 0:
+            raise FileNotFoundError(f"Empty drive log {log_dir}")
+        if fps is None:
+            capture_times = np.array([record['timestamps'][0] for record in self.reader])
+            step_time = np.mean(np.diff(capture_times)) if len(capture_times) > 1 else 0
+            fps = 1/step_time if step_time > 0 else 20.0
+        super().__init__(fps=fps,realtime=realtime,loop=loop)
+        self.cam = cam
+        self.pos = 0
+
+    def _next_frame(self):
+        if self.pos >= len(self.reader):
+            return None
+        frame = cv2.cvtColor(self.reader[self.pos]['frames'][self.cam], cv2.COLOR_RGB2BGR)
+        self.pos += 1
+        return frame
+
+    def _rewind(self):
+        self.pos = 0
+
+
+def open_source(spec,realtime=False,loop=True):
+    """
+    input: video file, image directory or drive log directory (has meta.json)
+           "path#2" picks camera 2 of a drive log
+    return: FrameSource
+    """
+    path,_,cam = spec.partition('#')
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path,'meta.json')):
+            return DriveLogSource(path,cam=int(cam or 0),realtime=realtime,loop=loop)
+        return ImageDirSource(path,realtime=realtime,loop=loop)
+    return VideoFileSource(path,realtime=realtime,loop=loop)
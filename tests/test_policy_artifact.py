@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("stable_baselines3")
+pytest.importorskip("sb3_contrib")
+pytest.importorskip("onnxruntime")
+
+from system.modules.policy import artifact_path, export_policy, load_exported_policy, load_sb3
+from test_policy_engine import MODELS, DummyEnv
+
+ALGORITHMS = {'sac':'SAC','sac_sde':'SAC','tqc':'TQC','ppo':'PPO','ppo_sde_squash':'PPO'}
+
+
+def save_agent(agent_dir,name,zip_name="model.zip",scale=1.0):
+    """
+    agent folder like RLmodel/<agent>: config.json and a zip, weights scaled by scale
+    """
+    model = MODELS[name](DummyEnv())
+    with torch.no_grad():
+        for param in model.policy.parameters():
+            param.mul_(scale)
+    agent_dir.mkdir(exist_ok=True)
+    with open(agent_dir/"config.json",'w') as file:
+        json.dump({'algorithm':{'method':ALGORITHMS[name]}},file)
+    model.save(agent_dir/zip_name)
+    return str(agent_dir/zip_name)
+
+
+@pytest.mark.parametrize("fmt",['npz','onnx'])
+@pytest.mark.parametrize("name",sorted(MODELS))
+def test_export_parity(name,fmt,tmp_path):
+    # large weights, float32 kernels of NumPy / onnx runtime drift ~1e-5 from torch
+    model_path = save_agent(tmp_path/"agent",name,scale=3.0)
+    path = export_policy(model_path,fmt)
+    assert path == artifact_path(model_path,fmt)
+
+    model = load_sb3(model_path,ALGORITHMS[name],"cpu")
+    runtime = load_exported_policy(model_path)
+    rng = np.random.default_rng(0)
+    for _ in range(16):
+        observation = rng.normal(scale=3.0,size=(1,80)).astype(np.float32)
+        expected,_ = model.predict(observation,deterministic=True)
+        actions,_ = runtime.predict(observation)
+        assert actions.shape == expected.shape and actions.dtype == expected.dtype
+        np.testing.assert_allclose(actions,expected,atol=1e-4,rtol=1e-4)
+
+
+def test_artifact_belongs_to_its_zip(tmp_path):
+    agent_dir = tmp_path/"agent"
+    model_path = save_agent(agent_dir,'sac')
+    other_path = save_agent(agent_dir,'sac',zip_name="other.zip")
+    export_policy(model_path,'npz')
+
+    assert load_exported_policy(model_path) is not None
+    # an other checkpoint of the folder doesn't pick up model.policy.npz
+    assert load_exported_policy(other_path) is None
+
+    # retrained in place, the artifact is stale
+    save_agent(agent_dir,'sac')
+    assert load_exported_policy(model_path) is None
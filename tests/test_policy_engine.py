@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+gym = pytest.importorskip("gymnasium")
+stable_baselines3 = pytest.importorskip("stable_baselines3")
+sb3_contrib = pytest.importorskip("sb3_contrib")
+
+from system.modules.policy import PolicyEngine
+
+
+class DummyEnv(gym.Env):
+    """
+    observation / action spaces of the driving agents: (1,latent) observation, steer / throttle
+    """
+
+    def __init__(self,obs_dim=80):
+        self.observation_space = gym.spaces.Box(-np.inf,np.inf,(1,obs_dim),np.float32)
+        self.action_space = gym.spaces.Box(np.array([-1,0],dtype=np.float32),np.array([1,1],dtype=np.float32))
+
+    def reset(self,seed=None,options=None):
+        return np.zeros(self.observation_space.shape,dtype=np.float32),{}
+
+    def step(self,action):
+        return np.zeros(self.observation_space.shape,dtype=np.float32),0.0,False,False,{}
+
+
+MODELS = {
+    'sac':lambda env: stable_baselines3.SAC('MlpPolicy',env),
+    'sac_sde':lambda env: stable_baselines3.SAC('MlpPolicy',env,use_sde=True,
+                                                policy_kwargs={'log_std_init':-3,'net_arch':[64,32]}),
+    'tqc':lambda env: sb3_contrib.TQC('MlpPolicy',env),
+    'ppo':lambda env: stable_baselines3.PPO('MlpPolicy',env),
+    'ppo_sde_squash':lambda env: stable_baselines3.PPO('MlpPolicy',env,use_sde=True,
+                                                       policy_kwargs={'squash_output':True}),
+}
+
+
+@pytest.mark.parametrize("name",sorted(MODELS))
+def test_predict_parity(name,tmp_path):
+    model = MODELS[name](DummyEnv())
+    # the agent runs a loaded model
+    model.save(tmp_path/"model.zip")
+    model = type(model).load(tmp_path/"model.zip",device="cpu")
+    engine = PolicyEngine(model)
+
+    rng = np.random.default_rng(0)
+    # large observations reach the clip / tanh saturation of the post-processing
+    observations = [rng.normal(scale=3.0,size=(1,80)).astype(np.float32) for _ in range(32)]
+    observations.append(rng.normal(size=(1,80)))  # float64 is cast like SB3 does
+    for observation in observations:
+        expected,_ = model.predict(observation,deterministic=True)
+        actions,_ = engine.predict(observation)
+        assert actions.shape == expected.shape
+        assert actions.dtype == expected.dtype
+        np.testing.assert_array_equal(actions,expected)
+
+    # a batch of observations keeps its batch dimension
+    batch = np.stack(observations[:8])
+    expected,_ = model.predict(batch,deterministic=True)
+    actions,_ = engine.predict(batch)
+    np.testing.assert_array_equal(actions,expected)
@@ -0,0 +1,227 @@
+"""
+offline content-addressed store for the models of an agent
+
+python -m wrapper.model_store import RLmodel/SAC_51/model.zip
+python -m wrapper.model_store verify RLmodel/SAC_51/model.zip
+
+import (needs the hub or the hub cache once) copies every artifact of the agent config into the
+store and writes store_manifest.json next to the agent config. Agent then loads from the store
+only: seg model from a local directory (safetensors, memory mapped), VAE weights converted to
+safetensors (memory mapped), policy zip by content address. nothing is looked up on the hub.
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+
+import torch
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_ROOT = os.path.join(os.path.expanduser('~'),'.cache','avbot','store')
+STORE_MANIFEST = 'store_manifest.json'
+# files of a HF model repo the wrappers need
+HF_PATTERNS = ['*.json','*.safetensors','*.txt','*.model']
+
+
+def file_digest(path,block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path,'rb') as file:
+        for block in iter(lambda: file.read(block_size),b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ModelStore:
+    """
+    root/blobs/<sha256><ext>    file contents, named by digest
+    root/trees/<sha256>/<name>  directories (HF repos) linking to blobs, named by the digest of their listing
+
+    root: store directory, default ~/.cache/avbot/store (AVBOT_MODEL_STORE overrides)
+    """
+
+    def __init__(self,root=None):
+        self.root = root or os.environ.get('AVBOT_MODEL_STORE',DEFAULT_ROOT)
+        self.blob_dir = os.path.join(self.root,'blobs')
+        self.tree_dir = os.path.join(self.root,'trees')
+
+    def blob_path(self,name):
+        return os.path.join(self.blob_dir,name)
+
+    def tree_path(self,name):
+        return os.path.join(self.tree_dir,name)
+
+    def add_file(self,path,move=False):
+        """
+        copy a file into the store, never hard linked: an in place overwrite of the source
+        (SB3 save truncates the same inode) would change the blob
+        move: move instead of copy, only for files the store owns (converted state dicts)
+        return: blob name, <sha256><ext>
+        """
+        name = file_digest(path)+os.path.splitext(path)[1]
+        blob_path = self.blob_path(name)
+        if not os.path.exists(blob_path):
+            os.makedirs(self.blob_dir,exist_ok=True)
+            if move:
+                os.replace(path,blob_path)
+            else:
+                tmp_path = blob_path+'.tmp'
+                shutil.copyfile(path,tmp_path)
+                os.replace(tmp_path,blob_path)
+        return name
+
+    def add_tree(self,directory,patterns=None):
+        """
+        store every file of directory (matching patterns) and link them in a tree
+        return: tree name
+        """
+        import fnmatch
+        files = {}
+        for dirpath,_,filenames in os.walk(directory):
+            for filename in filenames:
+                rel_path = os.path.relpath(os.path.join(dirpath,filename),directory)
+                if patterns and not any(fnmatch.fnmatch(filename,p) for p in patterns):
+                    continue
+                files[rel_path.replace(os.sep,'/')] = self.add_file(os.path.join(dirpath,filename))
+        listing = json.dumps(sorted(files.items())).encode()
+        name = hashlib.sha256(listing).hexdigest()
+        tree_path = self.tree_path(name)
+        if not os.path.isdir(tree_path):
+            tmp_path = tree_path+'.tmp'
+            shutil.rmtree(tmp_path,ignore_errors=True)
+            for rel_path,blob in files.items():
+                link_path = os.path.join(tmp_path,rel_path)
+                os.makedirs(os.path.dirname(link_path),exist_ok=True)
+                try:
+                    os.symlink(os.path.relpath(self.blob_path(blob),os.path.dirname(link_path)),link_path)
+                except OSError:
+                    shutil.copyfile(self.blob_path(blob),link_path)
+            os.replace(tmp_path,tree_path)
+        return name
+
+    def add_state_dict(self,path):
+        """
+        store a torch .pth state dict as safetensors so it can be loaded memory mapped
+        return: blob name
+        """
+        from safetensors.torch import save_file
+        state_dict = torch.load(path,map_location='cpu',weights_only=True)
+        tmp_path = os.path.join(self.root,f'convert_{os.getpid()}.safetensors')
+        os.makedirs(self.root,exist_ok=True)
+        try:
+            save_file({k:v.contiguous() for k,v in state_dict.items()},tmp_path)
+            return self.add_file(tmp_path,move=True)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _hf_directory(model_repo):
+        if os.path.isdir(model_repo):
+            return model_repo
+        from huggingface_hub import snapshot_download
+        try:
+            return snapshot_download(model_repo,allow_patterns=HF_PATTERNS)
+        except Exception as e:
+            logging.warning(f"hub unreachable ({e}), using the local hub cache of {model_repo}")
+            return snapshot_download(model_repo,allow_patterns=HF_PATTERNS,local_files_only=True)
+
+    def import_agent(self,model_path):
+        """
+        store the seg model, vae encoder / decoder and policy of an agent, write store_manifest.json
+        return: manifest
+        """
+        model_dir = os.path.dirname(model_path)
+        with open(os.path.join(model_dir,"config.json"),'rb') as file:
+            observer_config = json.load(file)['env']['observer_config']['config']
+
+        manifest = {'root':os.path.abspath(self.root),
+                    'policy':self.add_file(model_path),
+                    'policy_name':os.path.basename(model_path)}
+        seg_config = observer_config.get('seg_model_config',{}).get('config',{})
+        if 'model_repo' in seg_config:
+            manifest['seg'] = self.add_tree(self._hf_directory(seg_config['model_repo']),HF_PATTERNS)
+        encoder_config = observer_config.get('vae_encoder_config')
+        if encoder_config is not None:
+            manifest['vae_encoder'] = self.add_state_dict(encoder_config['model_path'])
+            decoder_config = observer_config.get('vae_decoder_config')
+            decoder_path = decoder_config['model_path'] if decoder_config else \
+                           os.path.join(os.path.dirname(encoder_config['model_path']),"decoder_model.pth")
+            if os.path.exists(decoder_path):
+                manifest['vae_decoder'] = self.add_state_dict(decoder_path)
+
+        with open(os.path.join(model_dir,STORE_MANIFEST),'w') as file:
+            json.dump(manifest,file,indent=4)
+        logging.info(f"stored agent {model_path}: {manifest}")
+        return manifest
+
+    def verify(self,manifest):
+        """
+        return: list of missing or corrupted artifacts of a manifest
+        """
+        problems = []
+        for key in ('policy','vae_encoder','vae_decoder'):
+            if key in manifest:
+                blob = manifest[key]
+                path = self.blob_path(blob)
+                if not os.path.exists(path) or file_digest(path) != os.path.splitext(blob)[0]:
+                    problems.append(key)
+        if 'seg' in manifest and not os.path.isdir(self.tree_path(manifest['seg'])):
+            problems.append('seg')
+        return problems
+
+
+def apply_manifest(model_path,env_config):
+    """
+    point the agent config at the store when store_manifest.json is next to the agent and
+    was imported from this zip (same content, or same name when the zip isn't on disk),
+    other zips of the folder load as they are
+
+    env_config: 'env' of the agent config, updated in place
+    return: policy path to load (the stored zip, or model_path)
+    """
+    manifest_path = os.path.join(os.path.dirname(model_path),STORE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return model_path
+    with open(manifest_path,'r') as file:
+        manifest = json.load(file)
+    if os.path.exists(model_path):
+        imported = file_digest(model_path) == os.path.splitext(manifest['policy'])[0]
+    else:
+        imported = manifest.get('policy_name') == os.path.basename(model_path)
+    if not imported:
+        logging.warning(f"{model_path} isn't the zip in {manifest_path}, not loading from the store")
+        return model_path
+    store = ModelStore(manifest['root'])
+    observer_config = env_config['observer_config']['config']
+
+    if 'seg' in manifest:
+        observer_config['seg_model_config']['config']['model_repo'] = store.tree_path(manifest['seg'])
+    if 'vae_encoder' in manifest:
+        observer_config['vae_encoder_config']['model_path'] = store.blob_path(manifest['vae_encoder'])
+    if 'vae_decoder' in manifest:
+        observer_config['vae_decoder_config'] = {'model_path':store.blob_path(manifest['vae_decoder']),
+                                                 'latent_dims':observer_config['vae_encoder_config']['latent_dims']}
+    print(f"loading models from store {store.root}")
+    return store.blob_path(manifest['policy'])
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import','verify'):
+        print(__doc__)
+        sys.exit(1)
+    command, model_path = sys.argv[1:]
+    if command == 'import':
+        ModelStore().import_agent(model_path)
+        return
+    with open(os.path.join(os.path.dirname(model_path),STORE_MANIFEST),'r') as file:
+        manifest = json.load(file)
+    problems = ModelStore(manifest['root']).verify(manifest)
+    print(f"missing or corrupted: {problems}" if problems else "store ok")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
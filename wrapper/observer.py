@@ -2,6 +2,8 @@
 
 from collections import deque
 import numpy as np
+import cv2
+import torch
 
 # semantic segmentation
 from segmentation import seg_hf
@@ -32,12 +34,76 @@ class RawObserver:
 
         return arg["imgs"]
     
+class FrameChangeGate:
+    """
+    detect near identical frames so seg + vae can be skipped while the scene is static
+
+    every camera frame is subsampled with stride then area-downsampled to size and compared
+    with the last processed one, mean abs difference in uint8 levels. frames count as unchanged when
+    every camera is below threshold, at most max_reuse steps in a row so the state is
+    refreshed even when the scene drifts slowly.
+
+    threshold: mean abs difference (0-255) under which a frame is reused
+    max_reuse: maximum consecutive reused steps
+    size: (w,h) of the compared thumbnails
+    stride: pixel stride before the area resize, keeps the check around 0.5 ms per 720p camera
+    """
+
+    def __init__(self,threshold=2.0,max_reuse=5,size=(64,36),stride=4):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.size = tuple(size)
+        self.stride = stride
+        self.reset()
+        self.steps = 0
+        self.reused = 0
+
+    def reset(self):
+        self.reference = None
+        self.reuse_count = 0
+        self.last_diff = None
+
+    def _thumbnails(self,imgs):
+        return np.stack([cv2.resize(img[::self.stride,::self.stride],self.size,interpolation=cv2.INTER_AREA)
+                         for img in imgs]).astype(np.int16)
+
+    def unchanged(self,imgs):
+        """
+        input: list of frames of this step
+        return: True if the previous seg / latent can be reused, else the frames become the reference
+        """
+        self.steps += 1
+        thumbnails = self._thumbnails(imgs)
+        if self.reference is not None and self.reference.shape == thumbnails.shape:
+            self.last_diff = float(np.abs(thumbnails-self.reference).mean(axis=(1,2,3)).max())
+            if self.last_diff < self.threshold and self.reuse_count < self.max_reuse:
+                self.reuse_count += 1
+                self.reused += 1
+                return True
+        self.reference = thumbnails
+        self.reuse_count = 0
+        return False
+
+    def get_stats(self):
+        return {'steps':self.steps,
+                'reused':self.reused,
+                'reuse_rate':self.reused/self.steps if self.steps else 0.0,
+                'last_diff':self.last_diff}
+
+
 class SegVaeObserver:
     """
     class for convert image observation to state space
 
     seg_model_config = HFsegwrapper module
     vae_model = VencoderWrapper
+    frame_gate_config = FrameChangeGate kwargs, reuse seg map and latent on static scenes (None: off)
+    perception_config = FusedPerception kwargs (compile, compile_mode), run seg + vae encoder
+                        as one PerceptionModule (None: staged wrappers)
+    n_cam = number of camera frames per step, shape of the warmup pass
+
+    models are warmed up once at the deployment shape, the timing loops are opt-in
+    (benchmark() of the wrappers, benchmark.py --models)
 
     """
 
@@ -45,15 +111,35 @@ class SegVaeObserver:
     def __init__(self,                
                 seg_model_config,
                 vae_encoder_config,
-                vae_decoder_config=None):
+                vae_decoder_config=None,
+                frame_gate_config=None,
+                perception_config=None,
+                n_cam=1):
         
         # select type of seg model and config
-        seg_class = getattr(seg_hf,seg_model_config['name'])
-        self.seg = seg_class(**seg_model_config['config'])
-        self.vae_encoder = VencoderWrapper(**vae_encoder_config)
-        self.vae_decoder = DecoderWrapper(**vae_decoder_config) if vae_decoder_config is not None else None
+        if hasattr(seg_hf,seg_model_config['name']):
+            seg_class = getattr(seg_hf,seg_model_config['name'])
+        else:
+            # onnxruntime is only needed for the onnx backend
+            from segmentation import seg_onnx
+            seg_class = getattr(seg_onnx,seg_model_config['name'])
+        # one warmup pass at the real shape, the perception module warms up seg + encoder itself
+        warmup_batch = n_cam if perception_config is None else 0
+        self.n_cam = n_cam
+        self.seg = seg_class(**{'warmup_batch':warmup_batch,**seg_model_config['config']})
+        self.vae_encoder = VencoderWrapper(**{'warmup_batch':warmup_batch,
+                                              'warmup_shape':getattr(self.seg,'output_shape',None),
+                                              **vae_encoder_config})
+        self.vae_decoder = DecoderWrapper(**{'warmup_batch':n_cam,**vae_decoder_config}) \
+                            if vae_decoder_config is not None else None
         self.len_latent = self.vae_encoder.latent_dims
         self.cam_adjust = {}
+        self.frame_gate = FrameChangeGate(**frame_gate_config) if frame_gate_config is not None else None
+        self.perception = None
+        if perception_config is not None:
+            from wrapper.perception import FusedPerception
+            self.perception = FusedPerception(self.seg,self.vae_encoder,n_cam=n_cam,**perception_config)
+            self.perception.warmup()
     def reset(self,imgs):
 
         raise NotImplementedError("Method 'reset' must be implemented in subclasses")
@@ -66,42 +152,88 @@ class SegVaeObserver:
         self.cam_adjust = cam_adjust
 
     
+    @staticmethod
     def adjust_cam_angle(image, rows):
-        height, width, channels = image.shape
+        """
+        shift a seg map (numpy or torch, (h,w) or (h,w,c)) down by rows, up if negative, filled with 0
+        """
+        height = image.shape[0]
         
         # Limit rows to half the image height
         rows = max(min(rows, height // 2), -height // 2)
         
+        new_image = image.clone() if isinstance(image,torch.Tensor) else image.copy()
         if rows > 0:
             # Add black rows at the top and remove from bottom
-            new_image = np.zeros_like(image)
-            new_image[rows:, :, :] = image[:-rows, :, :]
+            new_image[:rows] = 0
+            new_image[rows:] = image[:-rows]
         elif rows < 0:
             # Remove rows from top and add black rows at bottom
-            new_image = np.zeros_like(image)
-            new_image[:height+rows, :, :] = image[-rows:, :, :]
-        else:
-            # No change if rows is 0
-            new_image = image.copy()
+            new_image[height+rows:] = 0
+            new_image[:height+rows] = image[-rows:]
         
         return new_image
 
     def get_latent(self,imgs):
 
+        if self.frame_gate is not None and self.frame_gate.unchanged(imgs):
+            # pred_segs, latents and cat_latent of the last processed frames
+            return self.cat_latent
+
+        if self.perception is not None and not self.cam_adjust:
+            self.latents, self.pred_segs = self.perception(imgs)
+            self.cat_latent = self.latents.flatten().cpu().numpy()
+            return self.cat_latent
+
         self.pred_segs = self.seg(imgs)
         for k,v in self.cam_adjust.items():
             if k < len(self.pred_segs):
                 self.pred_segs[k] = self.adjust_cam_angle(self.pred_segs[k],v)
         self.latents = self.vae_encoder(self.pred_segs)
         cat_latent = self.latents.flatten().cpu().numpy()
+        self.cat_latent = cat_latent
 
         return cat_latent
     
-    def get_renders(self):
+    def seg_maps(self):
+        """
+        return: pred_segs as a list of numpy maps, device resident seg maps are copied to host here
+        """
+        if isinstance(self.pred_segs,torch.Tensor):
+            return list(self.pred_segs.cpu().numpy())
+        return self.pred_segs
+
+    def render_state(self):
+        """
+        outputs of the last step for get_renders on another thread (system.modules.render),
+        every step assigns new seg maps and latents, device tensors are cloned in case a
+        compiled module reuses its output buffers
+        """
+        segs, latents = self.pred_segs, self.latents
+        if isinstance(segs,torch.Tensor):
+            segs = segs.clone()
+        return {'shape':self.seg.images[0].shape[:2],
+                'segs':segs,
+                'latents':latents.clone() if isinstance(latents,torch.Tensor) else latents}
+
+    def get_renders(self,state=None):
+        """
+        state: render_state() of a step, default the last step
+        return: [colorized seg maps, decoded latents (vae_decoder_config)]
+        """
+        state = state or self.render_state()
+        segs = state['segs']
+        if isinstance(segs,torch.Tensor):
+            segs = list(segs.cpu().numpy())
         obsr = []
-        obsr.append(self.seg.get_seg_images(self.pred_segs))
+        if getattr(self.seg,'output_size',None) is not None:
+            # low res seg maps are only upsampled here, for display
+            height,width = state['shape']
+            obsr.append(self.seg.get_seg_images(segs,shape=(width,height),interpolation=cv2.INTER_NEAREST))
+        else:
+            obsr.append(self.seg.get_seg_images(segs))
         if self.vae_decoder is not None:
-            obsr.append(self.vae_decoder(self.latents))
+            obsr.append(self.vae_decoder(state['latents']))
         return obsr
     
 
@@ -117,12 +249,16 @@ class SegVaeActManvHistObserver(SegVaeObserver):
                  maneuver_num=1,
                  hist_len = 8,
                  skip_frame=0,
-                 vae_decoder_config=None):
+                 vae_decoder_config=None,
+                 frame_gate_config=None,
+                 perception_config=None):
 
-        
         super().__init__(seg_model_config=seg_model_config,
                          vae_encoder_config=vae_encoder_config,
-                         vae_decoder_config=vae_decoder_config)
+                         vae_decoder_config=vae_decoder_config,
+                         frame_gate_config=frame_gate_config,
+                         perception_config=perception_config,
+                         n_cam=num_img_input)
 
         self.latent_space = self.vae_encoder.latent_dims
         self.skip_frame = skip_frame
@@ -138,6 +274,8 @@ class SegVaeActManvHistObserver(SegVaeObserver):
     
     def reset(self,imgs):
 
+        if self.frame_gate is not None:
+            self.frame_gate.reset()
         cat_latent = self.get_latent(imgs)
         observation = np.concatenate((cat_latent, [0]*self.act_num,[0]*self.maneuver_num), axis=-1)
         self.history_state.extend([observation]*((self.hist_len*(self.skip_frame+1))-self.skip_frame))
@@ -180,7 +318,10 @@ class ClipObserver:
 
         pass
 
-    def get_renders(self):
+    def render_state(self):
+        return None
+
+    def get_renders(self,state=None):
         return []
 
 
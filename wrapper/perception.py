@@ -0,0 +1,161 @@
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from segmentation import seg_hf
+from segmentation.preprocess import TensorProcessor
+
+
+class PerceptionModule(nn.Module):
+    """
+    seg model -> argmax -> label LUT -> resize to the VAE input -> /4 -> VAE encoder as one nn.Module
+
+    the glue of HFsegWrapper (_get_segmaps, label mapping, output_size) and VencoderWrapper
+    (resize, scaling) written in torch so the whole step can be compiled or exported as a unit.
+    shapes are static: n_cam frames of image_shape (crop of the agent config).
+
+    seg: HFsegWrapper with a label_mapping
+    vae_encoder: VencoderWrapper
+    image_shape: (h,w) of the frames given to the seg model
+    forward: pixel_values (n_cam,3,h,w) -> latents (n_cam,latent_dims), mapped uint8 seg maps
+    """
+
+    def __init__(self,seg,vae_encoder,image_shape):
+        super().__init__()
+        assert seg.label_mapping is not None, "perception module needs a label_mapping"
+        # the module is compiled as a whole, unwrap a compiled seg backbone
+        self.seg_model = getattr(seg.model,'_orig_mod',seg.model)
+        self.encoder = vae_encoder.model
+        self.mask2former = isinstance(seg,seg_hf.HF_mask2Formermodel)
+        self.register_buffer('label_lut',torch.from_numpy(seg.label_lut).to(seg.device))
+        self.output_size = seg.output_size
+        self.target_size = tuple(seg.output_size or image_shape)
+        self.input_size = vae_encoder.input_size
+        self.resize_mode = vae_encoder.resize_mode
+        # onnx has no antialiased resize, export_onnx turns it off
+        self.antialias = True
+
+    def forward(self,pixel_values):
+        if self.mask2former:
+            outputs = self.seg_model(pixel_values=pixel_values)
+            # same as post_process_semantic_segmentation
+            masks_probs = F.interpolate(outputs.masks_queries_logits,size=(384, 384),
+                                        mode="bilinear",align_corners=False).sigmoid()
+            masks_classes = outputs.class_queries_logits.softmax(dim=-1)[..., :-1]
+            scores = torch.einsum("bqc, bqhw -> bchw", masks_classes, masks_probs)
+            scores = F.interpolate(scores,size=self.target_size,mode="bilinear",align_corners=False)
+        else:
+            scores = self.seg_model(pixel_values=pixel_values).logits
+
+        labels = self.label_lut[scores.argmax(dim=1)]
+        if self.output_size is not None and tuple(labels.shape[-2:]) != self.output_size:
+            labels = F.interpolate(labels.unsqueeze(1),size=self.output_size,mode='nearest-exact').squeeze(1)
+
+        x = labels.unsqueeze(1).float()
+        if tuple(x.shape[-2:]) != self.input_size and self.resize_mode == 'nearest':
+            x = F.interpolate(x,size=self.input_size,mode='nearest-exact')
+        elif tuple(x.shape[-2:]) != self.input_size:
+            x = F.interpolate(x,size=self.input_size,mode='bilinear',antialias=self.antialias,align_corners=False).round()
+        latents = self.encoder(x/4.0)
+        return latents, labels
+
+
+class FusedPerception:
+    """
+    runs a PerceptionModule on camera frames: crop, TensorProcessor, module (eager or torch.compile)
+
+    n_cam: number of frames per step
+    image_shape: (h,w) given to the seg model, default the seg crop (one of them is required)
+    compile: torch.compile the module with static shapes
+    compile_mode: torch.compile mode, e.g. "max-autotune"
+    """
+
+    def __init__(self,seg,vae_encoder,n_cam,image_shape=None,compile=False,compile_mode=None):
+        assert image_shape is not None or seg.crop is not None, "static shapes need a crop or image_shape"
+        image_shape = tuple(image_shape or seg.crop)
+        self.seg = seg
+        self.n_cam = n_cam
+        self.image_shape = image_shape
+        self.module = PerceptionModule(seg,vae_encoder,image_shape).eval()
+        self.processor = seg.fast_processor or TensorProcessor(seg.processor,seg.device,seg.torch_dtype)
+        self.forward = torch.compile(self.module,dynamic=False,mode=compile_mode) if compile else self.module
+        self.compiled = compile
+
+    def example_input(self):
+        """
+        return: pixel_values of the deployment shape
+        """
+        frames = [np.zeros(self.image_shape+(3,),dtype=np.uint8)]*self.n_cam
+        return self.processor(frames)['pixel_values']
+
+    def warmup(self):
+        """
+        one pass at the deployment shape, compiles the module when compile is set
+        """
+        st = time.time()
+        with torch.no_grad():
+            self.forward(self.example_input())
+        print(f"perception warmup ({'compiled' if self.compiled else 'eager'}) :{time.time()-st:.6f}")
+
+    def __call__(self,imgs):
+        """
+        inputs: list of RGB frames
+        return: latents (n_cam,latent_dims), mapped seg maps on the model device
+        """
+        self.seg.images = self.seg.crop_images(imgs)
+        pixel_values = self.processor(self.seg.images)['pixel_values']
+        with torch.no_grad():
+            return self.forward(pixel_values)
+
+    def export_onnx(self,onnx_path,opset=17):
+        """
+        export the whole perception step, input pixel_values, outputs latents and seg maps
+        with the bilinear VAE resize_mode the resize to the VAE input is exported without
+        antialias, set seg output_size to the VAE input size (or nearest) for an exact export
+        """
+        self.module.antialias = False
+        try:
+            with torch.no_grad():
+                torch.onnx.export(self.module,(self.example_input().clone(),),onnx_path,
+                                  input_names=['pixel_values'],
+                                  output_names=['latents','seg_maps'],
+                                  opset_version=opset,
+                                  dynamo=False)
+        finally:
+            self.module.antialias = True
+        print(f"exported perception module to {onnx_path}")
+        return onnx_path
+
+
+def benchmark_perception(seg,vae_encoder,n_cam,image_shape=None,test_times=20,compile_mode=None):
+    """
+    per step latency of the staged wrappers, the eager PerceptionModule and the compiled one
+    on frames of the deployment shape
+    return: {name: seconds per step}
+    """
+    image_shape = tuple(image_shape or seg.crop)
+    frames = [np.random.randint(0,255,image_shape+(3,),dtype=np.uint8) for _ in range(n_cam)]
+
+    def staged():
+        return vae_encoder(seg(frames))
+
+    eager = FusedPerception(seg,vae_encoder,n_cam,image_shape)
+    st = time.time()
+    compiled = FusedPerception(seg,vae_encoder,n_cam,image_shape,compile=True,compile_mode=compile_mode)
+    compiled(frames)
+    print(f"compile time :{time.time()-st:.2f}s")
+
+    results = {}
+    for name,run in [('staged',staged),('eager',lambda: eager(frames)),('compiled',lambda: compiled(frames))]:
+        run()
+        st = time.time()
+        for _ in range(test_times):
+            run()
+        if seg.device.type == "cuda":
+            torch.cuda.synchronize()
+        results[name] = (time.time()-st)/test_times
+    print(" ".join(f"{name} :{t:.6f}" for name,t in results.items()))
+    return results
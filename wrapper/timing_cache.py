@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import platform
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'),'.cache','avbot','timings.json')
+
+
+class TimingCache:
+    """
+    per machine json file of model inference timings measured by the wrappers benchmark()
+
+    entries are keyed by machine, model (repo / path), backend (wrapper, device, dtype, options)
+    and input shape, so warmup can report the expected latency without running the timing loop.
+    path: json file, default ~/.cache/avbot/timings.json (AVBOT_TIMING_CACHE overrides)
+    """
+
+    def __init__(self,path=None):
+        self.path = path or os.environ.get('AVBOT_TIMING_CACHE',DEFAULT_PATH)
+
+    @staticmethod
+    def machine():
+        return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}"
+
+    def key(self,model,backend,shape):
+        return "|".join([self.machine(),str(model),str(backend),"x".join(str(s) for s in shape)])
+
+    def _load(self):
+        try:
+            with open(self.path,'r') as file:
+                return json.load(file)
+        except (OSError,ValueError):
+            return {}
+
+    def get(self,model,backend,shape):
+        """
+        return: {'mean': seconds, 'test_times', 'time'} or None
+        """
+        return self._load().get(self.key(model,backend,shape))
+
+    def put(self,model,backend,shape,mean,test_times):
+        entries = self._load()
+        entries[self.key(model,backend,shape)] = {'mean':mean,'test_times':test_times,'time':time.time()}
+        try:
+            os.makedirs(os.path.dirname(self.path),exist_ok=True)
+            tmp_path = self.path+'.tmp'
+            with open(tmp_path,'w') as file:
+                json.dump(entries,file,indent=4)
+            os.replace(tmp_path,self.path)
+        except OSError as e:
+            logging.warning(f"can't write timing cache {self.path}: {e}")
+
+
+def timed_warmup(run,model,backend,shape):
+    """
+    one warmup call of run, prints its time and the latency cached by timed_benchmark
+    shape: input shape of run, part of the cache key
+    return: output of run
+    """
+    st = time.time()
+    output = run()
+    print(f"warmup time :{time.time()-st:.6f}")
+    cached = TimingCache().get(model,backend,shape)
+    if cached is not None:
+        print(f"inference time :{cached['mean']:.6f} (cached)")
+    return output
+
+
+def timed_benchmark(run,model,backend,shape,test_times):
+    """
+    timing loop of run after one untimed call, stored in the timing cache
+    return: mean seconds per call
+    """
+    run()
+    st = time.time()
+    for _ in range(test_times):
+        run()
+    mean = (time.time()-st)/test_times
+    print(f"inference time :{mean:.6f}")
+    TimingCache().put(model,backend,shape,mean,test_times)
+    return mean